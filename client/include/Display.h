@@ -51,6 +51,9 @@
 #define VARIANT kVariant7Color
 #endif
 
+// The size in bytes of the header of each rectangle in a delta image.
+const uint8_t kDeltaHeaderSize = 8;
+
 // A high-level wrapper around the e-paper display.
 class Display {
  public:
@@ -59,9 +62,32 @@ class Display {
   // Initializes the display connection and buffers.
   void Initialize();
 
+  // Initializes the display connection and buffers without clearing the
+  // display, so that delta images can update parts of it.
+  void InitializePartial();
+
   // Loads partial image data onto the display and updates after each page.
   void Load(const uint8_t* image_data, uint32_t size, uint32_t offset);
 
+  // Prepares to decode a new run-length encoded image. If delta is true, the
+  // decoded data is a delta image.
+  void StartRunLength(bool delta = false);
+
+  // Decodes partial PackBits run-length encoded image data and loads it onto
+  // the display like Load() or LoadDelta(). The data may be split anywhere
+  // between calls.
+  void LoadRunLength(const uint8_t* encoded_data, uint32_t size);
+
+  // Prepares to load a new delta image.
+  void StartDelta();
+
+  // Loads partial delta image data onto the display. A delta image is a
+  // sequence of changed rectangles, each a header with the x, y, width, and
+  // height as big-endian 16-bit integers followed by the image data of the
+  // rectangle. Each rectangle gets a partial update after each page. The data
+  // may be split anywhere between calls.
+  void LoadDelta(const uint8_t* delta_data, uint32_t size);
+
   // Frees display buffers and sends the display to sleep.
   void Finalize();
 
@@ -71,14 +97,26 @@ class Display {
   // Shows the Wifi setup image.
   void ShowWifiSetup();
 
-  // Returns the width of the display in pixels.
+  // Returns the width of the display in pixels. Doesn't need the display to
+  // be initialized.
   int16_t Width();
 
-  // Returns the height of the display in pixels.
+  // Returns the height of the display in pixels. Doesn't need the display to
+  // be initialized.
   int16_t Height();
 
 
  private:
+  // Connects to the display and allocates its buffers. If initial is true,
+  // the display content is treated as unknown.
+  void Connect(bool initial);
+
+  // Loads decoded run-length encoded image data onto the display.
+  void LoadDecoded(const uint8_t* decoded_data, uint32_t size);
+
+  // Sets up the partial window for the delta image rectangle in the header.
+  void StartRectangle();
+
   // Converts one pixel from input encoding to display color encoding.
   uint16_t ConvertPixel(uint8_t input, uint8_t mask, uint8_t shift);
 
@@ -91,6 +129,33 @@ class Display {
 
   // The baud rate for the serial connection. Used for GxEPD2 logging.
   uint32_t serial_speed_;
+
+  // The number of image bytes decoded so far from run-length encoded data.
+  uint32_t decoded_offset_ = 0;
+
+  // The number of literal bytes left in the current run-length sequence.
+  uint32_t literal_count_ = 0;
+
+  // The number of times to repeat the next byte of run-length encoded data.
+  uint32_t repeat_count_ = 0;
+
+  // Whether the run-length encoded data decodes to a delta image.
+  bool delta_ = false;
+
+  // The header bytes of the current delta image rectangle.
+  uint8_t header_[kDeltaHeaderSize];
+
+  // The number of header bytes of the current rectangle received so far.
+  uint8_t header_count_ = 0;
+
+  // The position and size of the current delta image rectangle.
+  int16_t rectangle_x_ = 0;
+  int16_t rectangle_y_ = 0;
+  int16_t rectangle_width_ = 0;
+  int16_t rectangle_height_ = 0;
+
+  // The number of pixels of the current rectangle loaded so far.
+  uint32_t rectangle_pixel_ = 0;
 };
 
 #endif  // DISPLAY_H
@@ -29,6 +29,14 @@ class Network {
   bool HttpGet(HTTPClient* http, const String& base_url,
                const std::vector<String>& parameters);
 
+  // Opens a HTTP GET connection with the specified URL, parameters, and
+  // request headers, which are both expected to come as alternating keys and
+  // values. Collects the ETag response header. A 304 Not Modified response
+  // also succeeds, with the connection closed and `not_modified` set to true.
+  bool HttpGet(HTTPClient* http, const String& base_url,
+               const std::vector<String>& parameters,
+               const std::vector<String>& headers, bool* not_modified);
+
   // Deletes any saved Wifi SSID and password.
   void ResetWifi();
 
@@ -15,12 +15,23 @@ const String kBaseUrl = "http://192.168.86.23:8080";
 // The URL for the next wake time endpoint.
 const String kNextEndpoint = kBaseUrl + "/next";
 
-// The URL for the e-paper display image endpoint.
-const String kEpdEndpoint = kBaseUrl + "/epd";
+// The URL for the e-paper display image endpoint that only sends the regions
+// that changed since the image on the display.
+const String kEpdDeltaEndpoint = kBaseUrl + "/epd/delta";
+
+// The wire encoding requested for the e-paper display image.
+const String kEpdEncoding = "rle";
 
 // The size in bytes of the streaming HTTP response and image buffers.
 const uint32_t kStreamBufferSize = 1024;
 
+// The maximum length of an ETag stored for the last image shown.
+const size_t kMaxEtagLength = 64;
+
+// The ETag of the image on the display, kept in RTC memory during deep sleep.
+// Empty if the display shows anything else.
+RTC_DATA_ATTR char last_etag[kMaxEtagLength + 1] = "";
+
 // The time in milliseconds to wait before restarting after an error.
 uint64_t kRestartDelayMs = 60 * 60 * 1000;  // 1 hour
 
@@ -30,23 +41,57 @@ Network network(kSerialSpeed);
 Power power;
 
 // Streams the image from the server and sends it to the display in chunks.
+// Only updates the regions that changed and leaves the display alone if the
+// image is the one it already shows.
 bool downloadImage() {
   Serial.println("Downloading image");
   HTTPClient http;
 
-  // Request the current image from the server.
-  if (!network.HttpGet(&http, kEpdEndpoint,
+  // Request the current image from the server, compressed to keep the
+  // transfer short. Sending the ETag of the image on the display lets the
+  // server respond with only the changes or nothing at all.
+  std::vector<String> headers;
+  if (last_etag[0] != '\0') {
+    headers = {"If-None-Match", last_etag};
+  }
+  bool not_modified;
+  if (!network.HttpGet(&http, kEpdDeltaEndpoint,
                        {"width", String(display.Width()),
-                        "height", String(display.Height())})) {
+                        "height", String(display.Height()),
+                        "encoding", kEpdEncoding},
+                       headers, &not_modified)) {
     return false;
   }
-
-  // Start reading from the stream.
+  if (not_modified) {
+    Serial.println("Image not modified");
+    return true;
+  }
+  String etag = http.header("ETag");
+
+  // The server sends the compressed image with its length once it's complete,
+  // but it may still arrive in pieces. Keep reading until the full length has
+  // arrived. An empty image means that nothing visible changed.
+  int32_t content_length = http.getSize();
+  if (content_length < 0) {
+    Serial.println("Unknown image size");
+    http.end();
+    return false;
+  }
+  uint32_t size = content_length;
+
+  // Start reading from the stream. The image on the display is about to
+  // change, so forget its ETag until the new one is complete. Keep the
+  // display content for the regions that haven't changed.
+  last_etag[0] = '\0';
+  if (size > 0) {
+    display.InitializePartial();
+    display.StartRunLength(true);
+  }
   uint8_t buffer[kStreamBufferSize];
   WiFiClient* stream = http.getStreamPtr();
   uint32_t total_count = 0;
-  do {
-    if (!http.connected()) {
+  while (total_count < size) {
+    if (!http.connected() && stream->available() == 0) {
       Serial.println("Connection lost");
       http.end();
       return false;
@@ -54,18 +99,28 @@ bool downloadImage() {
 
     Serial.printf("%d bytes available\n", stream->available());
 
-    // Fill the buffer.
-    uint32_t count = stream->readBytes(buffer, sizeof(buffer));
+    // Fill the buffer, but don't wait for more than the rest of the image.
+    uint32_t remaining = size - total_count;
+    uint32_t count = stream->readBytes(
+        buffer, remaining < sizeof(buffer) ? remaining : sizeof(buffer));
 
-    // Send the buffer to the display.
-    display.Load(buffer, count, total_count);
+    // Decode the buffer and send it to the display.
+    display.LoadRunLength(buffer, count);
 
     total_count += count;
     Serial.printf("Read %lu bytes (%lu total)\n", count, total_count);
-  } while (stream->available() > 0);
+  }
 
   Serial.println("Download complete");
   http.end();
+  if (size > 0) {
+    display.Finalize();
+  }
+
+  // Remember the image to skip downloading it again.
+  if (etag.length() <= kMaxEtagLength) {
+    strcpy(last_etag, etag.c_str());
+  }
   return true;
 }
 
@@ -99,17 +154,16 @@ void setup() {
 
   // Connect to Wifi or start the setup flow.
   if (!network.ConnectWifi()) {
+    last_etag[0] = '\0';
     display.ShowWifiSetup();
     network.StartWifiSetupServer();
     return;
   }
 
   // Show the latest image.
-  display.Initialize();
   if (!downloadImage()) {
     return;
   }
-  display.Finalize();
 
   // Go to sleep until the next refresh.
   scheduleSleep();
@@ -123,6 +177,7 @@ void loop() {
 
   // Falling through means there was an error.
   Serial.println("Restarting after error");
+  last_etag[0] = '\0';
   display.ShowError();
   power.DeepSleep(kRestartDelayMs);
 }
@@ -12,12 +12,31 @@ const int8_t kSpiPinRst = 18;  // RST signal
 const int8_t kSpiPinBusy = 5;  // BUSY signal
 const int8_t kPowerPin = 4;    // Power control
 
+// The size in bytes of the buffer for decoded run-length encoded image data.
+const uint32_t kDecodeBufferSize = 256;
+
 SPIClass hspi(HSPI);
 GxEPD2_3C<GxEPD2_750c_Z08, GxEPD2_750c_Z08::HEIGHT>* gx_epd_ = nullptr;
 
 void Display::Initialize() {
     Serial.println("Initializing display");
+    Connect(true);
+
+    gx_epd_->setFullWindow();
+    gx_epd_->firstPage();
+      do {
+        gx_epd_->fillScreen(GxEPD_WHITE);
+    } while (gx_epd_->nextPage());
+    gx_epd_->setFullWindow();
+    gx_epd_->firstPage();
+}
+
+void Display::InitializePartial() {
+    Serial.println("Initializing display for partial updates");
+    Connect(false);
+}
 
+void Display::Connect(bool initial) {
     // Power setup
     pinMode(kPowerPin, OUTPUT);
     digitalWrite(kPowerPin, HIGH);
@@ -32,14 +51,7 @@ void Display::Initialize() {
     hspi.begin(kSpiPinClk, -1, kSpiPinMosi, kSpiPinCs);
     gx_epd_->epd2.selectSPI(hspi, SPISettings(4000000, MSBFIRST, SPI_MODE0));
     
-    gx_epd_->init(115200);
-    gx_epd_->setFullWindow();
-    gx_epd_->firstPage();
-      do {
-        gx_epd_->fillScreen(GxEPD_WHITE);
-    } while (gx_epd_->nextPage());
-    gx_epd_->setFullWindow();
-    gx_epd_->firstPage();
+    gx_epd_->init(115200, initial);
 }
 
 void Display::Load(const uint8_t* image_data, uint32_t size, uint32_t offset) {
@@ -75,6 +87,134 @@ void Display::Load(const uint8_t* image_data, uint32_t size, uint32_t offset) {
     }
 }
 
+void Display::StartRunLength(bool delta) {
+    decoded_offset_ = 0;
+    literal_count_ = 0;
+    repeat_count_ = 0;
+    delta_ = delta;
+    if (delta) {
+        StartDelta();
+    }
+}
+
+void Display::LoadRunLength(const uint8_t* encoded_data, uint32_t size) {
+    uint8_t decoded[kDecodeBufferSize];
+    uint32_t decoded_count = 0;
+
+    for (uint32_t i = 0; i < size; ++i) {
+        uint8_t input = encoded_data[i];
+        uint32_t count = 0;
+
+        if (literal_count_ > 0) {
+            // Copy the next byte of a literal sequence.
+            count = 1;
+            --literal_count_;
+        } else if (repeat_count_ > 0) {
+            // Repeat the byte following a run header.
+            count = repeat_count_;
+            repeat_count_ = 0;
+        } else if (input < 128) {
+            // A header for the number of literal bytes that follow.
+            literal_count_ = input + 1;
+        } else if (input > 128) {
+            // A header for the number of times the next byte repeats.
+            repeat_count_ = 257 - input;
+        }
+
+        // Send the decoded bytes to the display whenever the buffer is full.
+        for (uint32_t j = 0; j < count; ++j) {
+            decoded[decoded_count++] = input;
+            if (decoded_count == kDecodeBufferSize) {
+                LoadDecoded(decoded, decoded_count);
+                decoded_count = 0;
+            }
+        }
+    }
+
+    if (decoded_count > 0) {
+        LoadDecoded(decoded, decoded_count);
+    }
+}
+
+void Display::LoadDecoded(const uint8_t* decoded_data, uint32_t size) {
+    if (delta_) {
+        LoadDelta(decoded_data, size);
+    } else {
+        Load(decoded_data, size, decoded_offset_);
+    }
+    decoded_offset_ += size;
+}
+
+void Display::StartDelta() {
+    header_count_ = 0;
+    rectangle_pixel_ = 0;
+}
+
+void Display::LoadDelta(const uint8_t* delta_data, uint32_t size) {
+    // For 3-color display, 4 pixels per byte (2 bits per pixel)
+    const uint8_t pixels_per_byte = 4;
+
+    for (uint32_t i = 0; i < size; ++i) {
+        uint8_t input = delta_data[i];
+
+        // Each rectangle starts with its header.
+        if (header_count_ < kDeltaHeaderSize) {
+            header_[header_count_++] = input;
+            if (header_count_ == kDeltaHeaderSize) {
+                StartRectangle();
+            }
+            continue;
+        }
+
+        // Write pixels to the rectangle. The last byte may be padded.
+        uint32_t rectangle_size =
+            (uint32_t) rectangle_width_ * (uint32_t) rectangle_height_;
+        for (int in = 0; in < pixels_per_byte &&
+             rectangle_pixel_ < rectangle_size; ++in) {
+            uint8_t shift = 2 * (pixels_per_byte - 1 - in);
+            uint16_t pixel = ConvertPixel(input, 0x3 << shift, shift);
+            int16_t column = rectangle_pixel_ % rectangle_width_;
+            int16_t row = rectangle_pixel_ / rectangle_width_;
+            gx_epd_->drawPixel(rectangle_x_ + column, rectangle_y_ + row,
+                               pixel);
+            ++rectangle_pixel_;
+
+            // Update the rectangle after each page and after its last row
+            if (column == rectangle_width_ - 1 &&
+                ((row + 1) % gx_epd_->pageHeight() == 0 ||
+                 row == rectangle_height_ - 1)) {
+                Serial.println("Updating display");
+                gx_epd_->nextPage();
+            }
+        }
+
+        // The next rectangle starts on the next byte.
+        if (rectangle_pixel_ == rectangle_size) {
+            header_count_ = 0;
+        }
+    }
+}
+
+void Display::StartRectangle() {
+    rectangle_x_ = (header_[0] << 8) | header_[1];
+    rectangle_y_ = (header_[2] << 8) | header_[3];
+    rectangle_width_ = (header_[4] << 8) | header_[5];
+    rectangle_height_ = (header_[6] << 8) | header_[7];
+    rectangle_pixel_ = 0;
+    Serial.printf("Loading rectangle %dx%d at (%d, %d)\n", rectangle_width_,
+                  rectangle_height_, rectangle_x_, rectangle_y_);
+
+    // Skip empty rectangles, which have no image data.
+    if (rectangle_width_ == 0 || rectangle_height_ == 0) {
+        header_count_ = 0;
+        return;
+    }
+
+    gx_epd_->setPartialWindow(rectangle_x_, rectangle_y_, rectangle_width_,
+                              rectangle_height_);
+    gx_epd_->firstPage();
+}
+
 void Display::Finalize() {
     Serial.println("Suspending display");
     gx_epd_->hibernate();
@@ -90,12 +230,12 @@ void Display::ShowWifiSetup() {
     ShowStatic(kWifiImageBlack, kWifiImageRed, kWifiWidth, kWifiHeight, GxEPD_WHITE);
 }
 
-int16_t Display::Width() { 
-    return gx_epd_->width(); 
+int16_t Display::Width() {
+    return GxEPD2_750c_Z08::WIDTH;
 }
 
-int16_t Display::Height() { 
-    return gx_epd_->height(); 
+int16_t Display::Height() {
+    return GxEPD2_750c_Z08::HEIGHT;
 }
 
 uint16_t Display::ConvertPixel(uint8_t input, uint8_t mask, uint8_t shift) {
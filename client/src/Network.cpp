@@ -113,7 +113,13 @@ bool Network::HttpGet(HTTPClient* http, const String& url) {
 
 bool Network::HttpGet(HTTPClient* http, const String& base_url,
                       const std::vector<String>& parameters) {
-  if (parameters.size() % 2 != 0) {
+  return HttpGet(http, base_url, parameters, {}, nullptr);
+}
+
+bool Network::HttpGet(HTTPClient* http, const String& base_url,
+                      const std::vector<String>& parameters,
+                      const std::vector<String>& headers, bool* not_modified) {
+  if (parameters.size() % 2 != 0 || headers.size() % 2 != 0) {
     Serial.printf("Incomplete pairs of keys and values for URL: %s\n",
                   base_url.c_str());
     return false;
@@ -137,8 +143,15 @@ bool Network::HttpGet(HTTPClient* http, const String& base_url,
   // Apply the read timeout after connecting.
   http->setTimeout(kReadTimeoutMs);
 
-  // Authenticate the request.
+  // Authenticate the request and add any other headers.
   AddAuthHeader(http);
+  for (int i = 0; i < headers.size(); i += 2) {
+    http->addHeader(headers[i], headers[i + 1]);
+  }
+
+  // Keep the ETag response header for conditional requests.
+  const char* response_headers[] = {"ETag"};
+  http->collectHeaders(response_headers, 1);
 
   int status = http->GET();
   if (status <= 0) {
@@ -148,6 +161,13 @@ bool Network::HttpGet(HTTPClient* http, const String& base_url,
   }
 
   Serial.printf("Status code: %d\n", status);
+  if (not_modified) {
+    *not_modified = status == HTTP_CODE_NOT_MODIFIED;
+    if (*not_modified) {
+      http->end();
+      return true;
+    }
+  }
   if (status != HTTP_CODE_OK) {
     http->end();
     return false;
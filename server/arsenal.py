@@ -13,6 +13,7 @@ from content import ImageContent
 from database import DataError
 from graphics import draw_text
 from graphics import SUBVARIO_CONDENSED_MEDIUM
+from layout import ellipsize
 
 # Football-data.org API endpoint
 FOOTBALL_API_URL = 'https://api.football-data.org/v4'
@@ -30,6 +31,7 @@ TEAMS_Y = 160
 SCORE_Y = 220
 TIME_Y = 280
 STATUS_Y = 340
+TEXT_MARGIN = 20
 
 
 class Arsenal(ImageContent):
@@ -116,7 +118,7 @@ class Arsenal(ImageContent):
             'EFL': 'League Cup',
             'CS': 'Community Shield',
         }
-        return short_names.get(code, name[:20])
+        return short_names.get(code, name)
 
     def image(self, user, width, height, variant):
         """Generate the Arsenal match image."""
@@ -146,12 +148,16 @@ class Arsenal(ImageContent):
             utc_date = match.get('utcDate', '')
 
             # Draw competition name
-            comp_name = self._get_competition_name(competition)
+            comp_name = ellipsize(self._get_competition_name(competition),
+                                  SUBVARIO_CONDENSED_MEDIUM,
+                                  width - 2 * TEXT_MARGIN)
             draw_text(comp_name, SUBVARIO_CONDENSED_MEDIUM, TEXT_COLOR,
                       xy=(width // 2, COMPETITION_Y), image=image, draw=draw)
 
             # Draw teams
-            teams_text = f'{home_team} vs {away_team}'
+            teams_text = ellipsize(f'{home_team} vs {away_team}',
+                                   SUBVARIO_CONDENSED_MEDIUM,
+                                   width - 2 * TEXT_MARGIN)
             draw_text(teams_text, SUBVARIO_CONDENSED_MEDIUM, TEXT_COLOR,
                       xy=(width // 2, TEAMS_Y), image=image, draw=draw)
 
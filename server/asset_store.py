@@ -0,0 +1,431 @@
+from cachetools import LRUCache
+from json import loads
+from logging import info
+from mmap import ACCESS_READ
+from mmap import mmap
+from numpy import array
+from numpy import bool_
+from numpy import copyto
+from numpy import frombuffer
+from numpy import uint8
+from numpy import uint32
+from numpy import unique
+from numpy import unpackbits
+from numpy import zeros
+from struct import calcsize
+from struct import unpack_from
+from threading import Lock
+from PIL import Image
+
+# The maximum total size in bytes of the decoded assets kept in memory. This
+# fits all city scene layers, which need about 41 MB as palette indices and
+# packed masks, without holding more than needed.
+MAX_ASSET_BYTES = 48 * 1024 * 1024
+
+# The sprite atlas with the city scene layers, as created by compile_assets.py.
+ATLAS_FILE = 'assets/city.atlas'
+
+# The first bytes of a sprite atlas file, identifying its format.
+ATLAS_MAGIC = b'SPRITES1'
+
+# The format of the sprite atlas file header: the magic bytes and the length of
+# the JSON table of contents following it. The sprite pixels and masks follow
+# the table.
+ATLAS_HEADER_FORMAT = '>8sI'
+
+# The maximum number of colors in a palette.
+MAX_PALETTE_COLORS = 256
+
+
+class Palette(object):
+    """A palette of colors shared by the assets composed in palette index
+    space, growing as assets with new colors are added."""
+
+    def __init__(self, colors=()):
+        self._colors = list(colors)
+        self._color_indices = {color: index for index, color
+                               in enumerate(self._colors)}
+        self._lock = Lock()
+
+    def index(self, color):
+        """Finds the index of the RGB color, adding it if it's new."""
+
+        with self._lock:
+            if color not in self._color_indices:
+                if len(self._colors) >= MAX_PALETTE_COLORS:
+                    raise ValueError('Too many colors for the palette')
+                self._color_indices[color] = len(self._colors)
+                self._colors.append(color)
+            return self._color_indices[color]
+
+    def indices(self, image):
+        """Maps the pixels of the RGB or palette image to an array of palette
+        indices."""
+
+        colors = image.getcolors(maxcolors=MAX_PALETTE_COLORS)
+        if colors is None:
+            raise ValueError('Too many colors for the palette')
+
+        # Map the used colors of a palette image to this palette, which only
+        # needs a lookup for each pixel.
+        if image.mode == 'P':
+            image_palette = image.getpalette()
+            lookup = zeros(MAX_PALETTE_COLORS, dtype=uint8)
+            for _, index in colors:
+                lookup[index] = self.index(
+                    tuple(image_palette[3 * index:3 * index + 3]))
+            return lookup[array(image)]
+
+        # Map each distinct color to its index and look up the pixels.
+        pixels = array(image, dtype=uint32)
+        codes = (pixels[:, :, 0] << 16) | (pixels[:, :, 1] << 8) | (
+            pixels[:, :, 2])
+        unique_codes, inverse = unique(codes, return_inverse=True)
+        unique_indices = array([self.index(((code >> 16) & 0xff,
+                                            (code >> 8) & 0xff, code & 0xff))
+                                for code in unique_codes.tolist()],
+                               dtype=uint8)
+
+        return unique_indices[inverse].reshape(codes.shape)
+
+    def tobytes(self):
+        """Returns the colors in the format used by Image.putpalette()."""
+
+        with self._lock:
+            return bytes(value for color in self._colors for value in color)
+
+
+class Asset(object):
+    """An image asset cropped to its visible pixels, kept as palette indices
+    with a mask for any transparency. It can be drawn onto images, or composed
+    onto arrays of palette indices."""
+
+    def __init__(self, width, height, offset=(0, 0), indices=None,
+                 palette=None, mask=None, mask_bits=None, visible=None,
+                 size_bytes=0):
+        self.width = width
+        self.height = height
+        self.offset = offset
+        self.indices = indices
+        self._palette = palette
+        # Binary masks are kept packed into bits and only unpacked when used.
+        # Others are kept as an image of their opacity.
+        self._mask = mask
+        self._mask_bits = mask_bits
+        # Composed runs of layers know which pixels are visible already.
+        self._visible = visible
+        self.size_bytes = size_bytes
+
+    @staticmethod
+    def from_image(image, palette):
+        """Decodes an asset from an image, mapping its colors to the
+        palette."""
+
+        # Map palette images, like most assets, straight from their palette.
+        rgba = image.convert('RGBA')
+        pixels = image if image.mode == 'P' else rgba.convert('RGB')
+
+        # Only keep the pixels within the bounding box of the visible ones.
+        alpha = rgba.getchannel('A')
+        box = alpha.getbbox()
+        if not box:
+            return Asset(image.width, image.height)
+        indices = palette.indices(pixels.crop(box))
+
+        # Most assets are either opaque or fully transparent in places, which
+        # only needs one bit per pixel.
+        alpha = alpha.crop(box)
+        histogram = alpha.histogram()
+        mask = None
+        mask_bits = None
+        if histogram[255] == alpha.width * alpha.height:
+            pass
+        elif not any(histogram[1:255]):
+            mask_bits = alpha.convert('1', dither=Image.NONE).tobytes()
+        else:
+            mask = alpha
+
+        size_bytes = indices.nbytes
+        if mask_bits is not None:
+            size_bytes += len(mask_bits)
+        if mask is not None:
+            size_bytes += alpha.width * alpha.height
+
+        return Asset(image.width, image.height, offset=box[:2],
+                     indices=indices, palette=palette, mask=mask,
+                     mask_bits=mask_bits, size_bytes=size_bytes)
+
+    @staticmethod
+    def from_indices(indices, visible):
+        """Creates an asset from an array of palette indices and an array of
+        which of them are visible, cropped to the visible ones."""
+
+        height, width = indices.shape
+        rows = visible.any(axis=1).nonzero()[0]
+        columns = visible.any(axis=0).nonzero()[0]
+        if not len(rows):
+            return Asset(width, height)
+
+        top, bottom = rows[0], rows[-1] + 1
+        left, right = columns[0], columns[-1] + 1
+        indices = indices[top:bottom, left:right].copy()
+        visible = visible[top:bottom, left:right].copy()
+        if visible.all():
+            visible = None
+
+        return Asset(width, height, offset=(int(left), int(top)),
+                     indices=indices, visible=visible,
+                     size_bytes=indices.nbytes + (
+                         visible.nbytes if visible is not None else 0))
+
+    @property
+    def pixels(self):
+        """The visible pixels as a palette image, or None if there are
+        none."""
+
+        if self.indices is None:
+            return None
+
+        pixels = Image.fromarray(self.indices, mode='P')
+        pixels.putpalette(self._palette.tobytes())
+        return pixels
+
+    @property
+    def mask(self):
+        """The mask of the visible pixels, or None if they are all opaque."""
+
+        if self._mask_bits is not None:
+            crop_height, crop_width = self.indices.shape
+            return Image.frombytes('1', (crop_width, crop_height),
+                                   self._mask_bits)
+
+        return self._mask
+
+    @property
+    def bounds(self):
+        """The position and size of the visible pixels within the asset, or
+        None if there are none."""
+
+        if self.indices is None:
+            return None
+        crop_height, crop_width = self.indices.shape
+
+        offset_x, offset_y = self.offset
+        return offset_x, offset_y, crop_width, crop_height
+
+    def _visible_region(self, left, top, right, bottom):
+        """Finds which pixels are visible within a rectangle of the cropped
+        asset, or None if they all are. Partial transparency counts as visible
+        from half opacity."""
+
+        if self._visible is not None:
+            return self._visible[top:bottom, left:right]
+
+        # Only unpack the bytes of the mask covering the rectangle.
+        if self._mask_bits is not None:
+            crop_height, _ = self.indices.shape
+            bits = frombuffer(self._mask_bits, dtype=uint8).reshape(
+                (crop_height, -1))
+            first_byte = left // 8
+            bits = bits[top:bottom, first_byte:(right + 7) // 8]
+            skip = left - 8 * first_byte
+            return unpackbits(bits, axis=1)[:, skip:skip + right - left].view(
+                bool_)
+
+        if self._mask is None:
+            return None
+        mask = array(self._mask.crop((left, top, right, bottom)))
+        if self._mask.mode == '1':
+            return mask
+        return mask >= 128
+
+    def compose(self, indices, xy, visible=None):
+        """Composes the asset onto an array of palette indices at the position,
+        clipped to its bounds and keeping it where the asset isn't visible.
+        Also marks the visible pixels in the optional array of them."""
+
+        bounds = self.bounds
+        if bounds is None:
+            return
+
+        # Clip the asset to the array, before touching any of its pixels.
+        x, y = xy
+        offset_x, offset_y, crop_width, crop_height = bounds
+        x += offset_x
+        y += offset_y
+        height, width = indices.shape
+        left = max(x, 0)
+        top = max(y, 0)
+        right = min(x + crop_width, width)
+        bottom = min(y + crop_height, height)
+        if left >= right or top >= bottom:
+            return
+
+        source = self.indices[top - y:bottom - y, left - x:right - x]
+        target = indices[top:bottom, left:right]
+        source_visible = self._visible_region(left - x, top - y, right - x,
+                                              bottom - y)
+        if source_visible is None:
+            target[:] = source
+            if visible is not None:
+                visible[top:bottom, left:right] = True
+        else:
+            copyto(target, source, where=source_visible)
+            if visible is not None:
+                visible[top:bottom, left:right] |= source_visible
+
+    def paste(self, image, xy):
+        """Pastes the asset onto the image at the position, keeping the image
+        where the asset is transparent."""
+
+        if self.indices is None:
+            return
+
+        x, y = xy
+        offset_x, offset_y = self.offset
+        image.paste(self.pixels, (x + offset_x, y + offset_y), self.mask)
+
+    def draw_mask(self, draw, xy, color):
+        """Draws the shape of the asset in a single color at the position."""
+
+        if self.indices is None:
+            return
+
+        x, y = xy
+        offset_x, offset_y = self.offset
+        x += offset_x
+        y += offset_y
+        mask = self.mask
+        if mask is not None:
+            draw.bitmap((x, y), mask, color)
+        else:
+            crop_height, crop_width = self.indices.shape
+            draw.rectangle([x, y, x + crop_width - 1, y + crop_height - 1],
+                           fill=color)
+
+
+class SpriteAtlas(object):
+    """A file of sprites with palette indices for pixels and packed bits for
+    masks, which is memory-mapped so that the pages are shared between
+    processes and only read from disk when used."""
+
+    def __init__(self, file):
+        with open(file, 'rb') as atlas_file:
+            self._map = mmap(atlas_file.fileno(), 0, access=ACCESS_READ)
+
+        magic, table_size = unpack_from(ATLAS_HEADER_FORMAT, self._map)
+        if magic != ATLAS_MAGIC:
+            raise ValueError('Not a sprite atlas: %s' % file)
+        table_start = calcsize(ATLAS_HEADER_FORMAT)
+        table = loads(self._map[table_start:table_start + table_size])
+
+        self.colors = [tuple(table['palette'][index:index + 3])
+                       for index in range(0, len(table['palette']), 3)]
+        self._sprites = table['sprites']
+        # The sprite offsets are relative to the end of the table.
+        self._data = memoryview(self._map)[table_start + table_size:]
+
+    def __contains__(self, path):
+        return path in self._sprites
+
+    def __len__(self):
+        return len(self._sprites)
+
+    def bounds(self, path):
+        """Returns the position and size of the visible pixels of the sprite at
+        the path."""
+
+        sprite = self._sprites[path]
+        offset_x, offset_y = sprite['offset']
+        crop_width, crop_height = sprite['size']
+
+        return offset_x, offset_y, crop_width, crop_height
+
+    def asset(self, path, palette):
+        """Creates the asset for the sprite at the path, referencing its pixels
+        and mask in the mapped file without copying them. The palette has to
+        start with the colors of the atlas."""
+
+        sprite = self._sprites[path]
+        crop_width, crop_height = sprite['size']
+
+        start = sprite['pixels']
+        end = start + crop_width * crop_height
+        indices = frombuffer(self._data[start:end], dtype=uint8).reshape(
+            (crop_height, crop_width))
+
+        mask_bits = None
+        if sprite['mask'] is not None:
+            start = sprite['mask']
+            end = start + (crop_width + 7) // 8 * crop_height
+            mask_bits = self._data[start:end]
+
+        return Asset(sprite['width'], sprite['height'],
+                     offset=tuple(sprite['offset']), indices=indices,
+                     palette=palette, mask_bits=mask_bits)
+
+
+class AssetStore(object):
+    """A store of decoded image assets shared by all content, evicting the
+    least recently used ones beyond a budget of bytes."""
+
+    def __init__(self, max_bytes=MAX_ASSET_BYTES, atlas_file=ATLAS_FILE):
+        self._assets = LRUCache(maxsize=max_bytes,
+                                getsizeof=lambda asset: asset.size_bytes)
+        self._lock = Lock()
+
+        # Use the sprite atlas if it has been compiled. Assets missing from it
+        # are decoded from their own files.
+        try:
+            self._atlas = SpriteAtlas(atlas_file)
+            info('Mapped %d sprites from %s' % (len(self._atlas), atlas_file))
+        except FileNotFoundError:
+            self._atlas = None
+
+        # Assets are composed in palette index space with the colors of the
+        # atlas, plus any of the other assets.
+        self.palette = Palette(self._atlas.colors if self._atlas else ())
+
+    def __getitem__(self, path):
+        """Returns the decoded asset at the path, decoding it if needed."""
+
+        with self._lock:
+            asset = self._assets.get(path)
+        if asset is not None:
+            return asset
+
+        if self._atlas is not None and path in self._atlas:
+            asset = self._atlas.asset(path, self.palette)
+        else:
+            asset = Asset.from_image(Image.open(path), self.palette)
+        with self._lock:
+            # Assets too big for the whole budget are never kept. Assets from
+            # the atlas don't count towards it, since their pages are shared.
+            if asset.size_bytes <= self._assets.maxsize:
+                self._assets[path] = asset
+
+        return asset
+
+    def bounds(self, path):
+        """Returns the position and size of the visible pixels of the asset at
+        the path, or None if there are none. Sprites in the atlas don't need to
+        be loaded for this."""
+
+        if self._atlas is not None and path in self._atlas:
+            return self._atlas.bounds(path)
+
+        return self[path].bounds
+
+    def warm_up(self, paths):
+        """Decodes the assets at the paths ahead of their first use."""
+
+        for path in paths:
+            self[path]
+
+        with self._lock:
+            info('Decoded %d assets (%d bytes)' % (
+                len(self._assets), self._assets.currsize))
+
+
+# The decoded assets shared by all content.
+assets = AssetStore()
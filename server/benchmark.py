@@ -0,0 +1,227 @@
+# To measure the latency and peak memory of the e-paper display pipeline for
+# each supported panel and write them to a file for comparing commits, run:
+# $ pip install absl-py
+# $ python benchmark.py --output=benchmark.json --baseline=previous.json
+#
+# The output of each function is checked against the reference digests in
+# benchmark_reference.json. After an intended change to the output, update
+# them with --update_reference.
+
+from absl import app
+from absl import flags
+from flask import Flask
+from hashlib import blake2b
+from io import BytesIO
+from json import dump
+from json import load
+from numpy import linspace
+from numpy import percentile
+from numpy import random
+from numpy import sin
+from numpy import stack
+from numpy import uint8
+from PIL import Image
+from PIL.ImageDraw import Draw
+from time import perf_counter
+from tracemalloc import get_traced_memory
+from tracemalloc import start
+from tracemalloc import stop
+
+from epd import _dither
+from epd import _rgb_pixels
+from epd import to_epd_bytes
+from epd import to_epd_image
+from epd import DEFAULT_DITHER
+from response import gif_response
+from response import render_cache
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('repeats', 20,
+                     'The number of times to time each function.')
+flags.DEFINE_string('output', 'benchmark.json',
+                    'The JSON file to write the results to.')
+flags.DEFINE_string('baseline', None,
+                    'An earlier results file to compare the results with.')
+flags.DEFINE_string('reference', 'benchmark_reference.json',
+                    'The JSON file with the digests of the expected outputs.')
+flags.DEFINE_bool('update_reference', False,
+                  'Whether to replace the expected outputs with the current '
+                  'ones instead of checking them.')
+
+# The width, height, and variant of each supported display panel.
+PANELS = [(640, 384, 'bwr'), (800, 480, 'bwr'), (880, 528, 'bwr'),
+          (1304, 984, 'bwr'), (800, 480, '7color')]
+
+# The artwork used as already quantized input.
+QUANTIZED_FILE = 'assets/artwork/eboy-san-francisco.gif'
+
+# The seed for the random noise in the photographic input.
+PHOTO_SEED = 0
+
+# The colors of the shapes in the flat color input.
+FLAT_COLORS = [(255, 255, 255), (0, 0, 0), (255, 0, 0), (40, 90, 200),
+               (250, 200, 30)]
+
+# The latency percentiles to report.
+PERCENTILES = [50, 90, 99]
+
+# The string format for each line of results.
+LINE_FORMAT = '%-16s %-10s %-16s %9s %9s %9s %10s %8s'
+
+
+def photo_input(width, height):
+    """Creates a photograph-like image with smooth color gradients and
+    noise."""
+
+    x = linspace(0, 1, width)[None, :]
+    y = linspace(0, 1, height)[:, None]
+    channels = [sin(3 * x + 2 * y), sin(5 * x * y + 1), sin(2 * x - 4 * y)]
+    pixels = 127.5 + 100 * stack(channels, axis=2)
+    noise = random.default_rng(PHOTO_SEED).normal(0, 20, pixels.shape)
+    pixels = (pixels + noise).clip(0, 255).astype(uint8)
+
+    return Image.fromarray(pixels)
+
+
+def flat_input(width, height):
+    """Creates an image of shapes and lines in a few flat colors, like most of
+    the content."""
+
+    image = Image.new('RGB', (width, height), color=FLAT_COLORS[0])
+    draw = Draw(image)
+    for index in range(24):
+        color = FLAT_COLORS[1 + index % (len(FLAT_COLORS) - 1)]
+        left = index * width // 24
+        top = (index * 7 % 24) * height // 24
+        box = [left, top, left + width // 8, top + height // 6]
+        if index % 2:
+            draw.ellipse(box, fill=color)
+        else:
+            draw.rectangle(box, fill=color)
+        draw.line([left, 0, width - left, height], fill=FLAT_COLORS[1])
+
+    return image
+
+
+def quantized_input(width, height):
+    """Creates an already quantized image from the artwork."""
+
+    image = Image.open(QUANTIZED_FILE)
+    return image.resize((width, height), resample=Image.NEAREST)
+
+
+# A Flask app providing the request context for responses.
+flask_app = Flask(__name__)
+
+# The input images by name.
+INPUTS = {'photo': photo_input, 'flat': flat_input,
+          'quantized': quantized_input}
+
+
+def gif_bytes(image, variant):
+    """Creates a GIF response for the image and returns its bytes."""
+
+    # Don't let the cache answer the repeated requests.
+    render_cache.clear()
+    with flask_app.test_request_context():
+        response = gif_response(image, variant)
+        response.direct_passthrough = False
+        return response.get_data()
+
+
+# The functions to measure by name, each returning output to check.
+FUNCTIONS = {
+    'to_epd_bytes': lambda image, variant: to_epd_bytes(image, variant),
+    'to_epd_image': lambda image, variant: (
+        to_epd_image(image, variant).tobytes()),
+    '_dither': lambda image, variant: _dither(
+        _rgb_pixels(image), variant, DEFAULT_DITHER).tobytes(),
+    'gif_response': gif_bytes
+}
+
+
+def measure(function, image, variant):
+    """Times the function and measures its peak memory use."""
+
+    times = []
+    for _ in range(FLAGS.repeats):
+        start_time = perf_counter()
+        output = function(image, variant)
+        times.append(perf_counter() - start_time)
+
+    # Tracing memory slows everything down, so it gets a separate run.
+    start()
+    function(image, variant)
+    _, peak_bytes = get_traced_memory()
+    stop()
+
+    result = {'p%d_ms' % p: percentile(times, p) * 1000 for p in PERCENTILES}
+    result['peak_bytes'] = peak_bytes
+    result['digest'] = output_digest(output)
+
+    return result
+
+
+def output_digest(output):
+    """Digests the output bytes. GIFs are decoded first, so that the digest
+    only depends on the pixels and not on the encoder."""
+
+    if output.startswith(b'GIF'):
+        output = Image.open(BytesIO(output)).convert('RGB').tobytes()
+
+    return blake2b(output, digest_size=16).hexdigest()
+
+
+def main(_):
+    results = {}
+    print(LINE_FORMAT % ('Panel', 'Input', 'Function', 'p50 (ms)', 'p90 (ms)',
+                         'p99 (ms)', 'Peak (KB)', 'Output'))
+    for width, height, variant in PANELS:
+        panel = '%dx%d-%s' % (width, height, variant)
+        for input_name, create_input in INPUTS.items():
+            image = create_input(width, height)
+            for function_name, function in FUNCTIONS.items():
+                key = '/'.join([panel, input_name, function_name])
+                results[key] = measure(function, image, variant)
+                print(LINE_FORMAT % (panel, input_name, function_name,
+                                     '%.2f' % results[key]['p50_ms'],
+                                     '%.2f' % results[key]['p90_ms'],
+                                     '%.2f' % results[key]['p99_ms'],
+                                     results[key]['peak_bytes'] // 1024,
+                                     results[key]['digest'][:8]))
+
+    with open(FLAGS.output, 'w') as output_file:
+        dump(results, output_file, indent=2, sort_keys=True)
+    print('Wrote results to %s' % FLAGS.output)
+
+    # Check that the outputs are bit for bit the same as the reference.
+    digests = {key: result['digest'] for key, result in results.items()}
+    if FLAGS.update_reference:
+        with open(FLAGS.reference, 'w') as reference_file:
+            dump(digests, reference_file, indent=2, sort_keys=True)
+        print('Updated reference outputs in %s' % FLAGS.reference)
+    else:
+        with open(FLAGS.reference) as reference_file:
+            reference = load(reference_file)
+        mismatches = [key for key, digest in digests.items()
+                      if reference.get(key) != digest]
+        for key in mismatches:
+            print('Output differs from reference: %s' % key)
+        if not mismatches:
+            print('All outputs match the reference')
+
+    # Compare the median latency with an earlier run.
+    if FLAGS.baseline:
+        with open(FLAGS.baseline) as baseline_file:
+            baseline = load(baseline_file)
+        for key, result in results.items():
+            if key in baseline:
+                print('%-48s %+7.1f%%' % (key, 100 * (
+                    result['p50_ms'] / baseline[key]['p50_ms'] - 1)))
+
+    if not FLAGS.update_reference and mismatches:
+        return 1
+
+
+if __name__ == '__main__':
+    app.run(main)
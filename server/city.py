@@ -1,7 +1,15 @@
+from cachetools import LRUCache
+from numpy import bool_
+from numpy import full
+from numpy import uint8
+from numpy import zeros
 from os.path import join as path_join
 from PIL import Image
 from random import random
+from threading import Lock
 
+from asset_store import Asset
+from asset_store import assets
 from content import ContentError
 from content import ImageContent
 from database import DataError
@@ -13,6 +21,70 @@ from weather import Weather
 # The directory containing city image assets.
 ASSETS_DIR = 'assets/city'
 
+# The maximum number of composed static scenes kept in the cache, one for each
+# combination of display size, daylight, weather, and day of the year.
+MAX_STATIC_SCENES = 16
+
+
+class _Step(object):
+    """A layer in a render plan, with its conditions resolved to indices."""
+
+    __slots__ = ['clauses', 'else_steps', 'probability', 'skip', 'path', 'xy',
+                 'xy_transform', 'xy_data']
+
+    def __init__(self):
+        # Each clause is a tuple of predicate indices, at least one of which
+        # has to evaluate to the required value.
+        self.clauses = []
+        # The earlier steps in the same group that have to not have been drawn.
+        self.else_steps = []
+        self.probability = None
+        # The number of steps in a layer group, skipped if it isn't drawn.
+        self.skip = 0
+        self.path = None
+        self.xy = None
+        self.xy_transform = None
+        self.xy_data = None
+
+
+class _Plan(object):
+    """The layers of the city scene flattened into a list of steps, with the
+    distinct predicates they depend on."""
+
+    __slots__ = ['steps', 'predicates', '_predicate_indices']
+
+    def __init__(self):
+        self.steps = []
+        self.predicates = []
+        self._predicate_indices = {}
+
+    def predicate_index(self, predicate):
+        """Finds the index of the predicate, adding it if it's new."""
+
+        if predicate not in self._predicate_indices:
+            self._predicate_indices[predicate] = len(self.predicates)
+            self.predicates.append(predicate)
+
+        return self._predicate_indices[predicate]
+
+
+class _StaticScene(object):
+    """The parts of the city scene for one combination of predicate values: a
+    base array of palette indices, followed by ranges of steps drawn by chance
+    and composed runs of layers that are always drawn."""
+
+    __slots__ = ['base', 'drawn', 'parts']
+
+    def __init__(self, width, height, num_steps):
+        # The background is black like an empty image.
+        self.base = full((height, width), assets.palette.index((0, 0, 0)),
+                         dtype=uint8)
+        # Whether each step is drawn, or None if that depends on chance.
+        self.drawn = [False] * num_steps
+        # Each part is a tuple of the start and end of a range of steps, or of
+        # None twice and a composed run.
+        self.parts = []
+
 
 class City(ImageContent):
     """A dynamic city scene that changes with the weather and other factors."""
@@ -21,6 +93,9 @@ class City(ImageContent):
         self._local_time = LocalTime(geocoder)
         self._sun = Sun(geocoder)
         self._weather = Weather(geocoder)
+        self._plan = self._compile(self._layers())
+        self._static_scenes = LRUCache(maxsize=MAX_STATIC_SCENES)
+        self._static_scenes_lock = Lock()
 
     def _day_of_year(self, user):
         """Returns the current day of the year in the users's time zone."""
@@ -952,90 +1027,247 @@ class City(ImageContent):
             ]
         }]
 
-    def _draw_layers(self, image, layers, user, width, height):
-        """Draws a list of layers onto an image."""
+    def _compile(self, layers):
+        """Flattens the layers into a render plan."""
 
-        # Keep track of drawn layers.
-        drawn_files = []
+        plan = _Plan()
+        self._compile_layers(layers, plan)
+
+        return plan
+
+    def _compile_layers(self, layers, plan):
+        """Appends the steps for a list of layers to the plan, recursively for
+        layer groups."""
+
+        index = plan.predicate_index
+
+        # Keep track of the steps for the files in this list of layers.
+        sibling_steps = []
 
-        # Draw the layers in order.
         for layer in layers:
-            try:
-                # Simple condition has to be true.
-                if not layer['condition'](user):
-                    continue
-            except KeyError:
-                pass
-
-            try:
-                # Negated condition has to be false.
-                if layer['not_condition'](user):
-                    continue
-            except KeyError:
-                pass
-
-            try:
-                # All and-conditions have to be true.
-                if not all([c(user) for c in layer['and_condition']]):
-                    continue
-            except KeyError:
-                pass
-
-            try:
-                # One or-condition has to be true.
-                if not any([c(user) for c in layer['or_condition']]):
-                    continue
-            except KeyError:
-                pass
-
-            try:
-                # Else layers have to not have been drawn.
-                if not set(layer['else_condition']).isdisjoint(drawn_files):
-                    continue
-            except KeyError:
-                pass
-
-            try:
-                # Evaluate a random probability.
-                if layer['probability'] <= 100 * random():
-                    continue
-            except KeyError:
-                pass
-
-            # Recursively draw groups of layers.
-            try:
-                self._draw_layers(image, layer['layers'], user, width, height)
-                continue  # Don't try to draw layer groups.
-            except KeyError:
-                pass
-
-            # Get the coordinates, optionally transforming them first.
-            try:
-                x, y = layer['xy_transform'](layer['xy_data'])
-            except KeyError:
-                x, y = layer['xy']
-
-            # Adjust the coordinates to be centered on the display.
-            x, y = adjust_xy(x, y, width, height)
-
-            # Draw the layer.
-            path = path_join(ASSETS_DIR, layer['file'])
-            bitmap = Image.open(path).convert('RGBA')
-            image.paste(bitmap, (x, y), bitmap)
-
-            # Remember the drawn file for the else condition.
-            drawn_files.append(layer['file'])
+            step = _Step()
+
+            if 'condition' in layer:
+                step.clauses.append(((index(layer['condition']),), True))
+            if 'not_condition' in layer:
+                step.clauses.append(((index(layer['not_condition']),), False))
+            for condition in layer.get('and_condition', []):
+                step.clauses.append(((index(condition),), True))
+            if 'or_condition' in layer:
+                step.clauses.append((tuple(
+                    index(condition) for condition in layer['or_condition']),
+                    True))
+
+            # Else layers can only refer to earlier layers in the same list,
+            # since the later ones haven't been drawn yet.
+            else_files = layer.get('else_condition', [])
+            step.else_steps = [sibling_index for sibling_index, sibling_file
+                               in sibling_steps if sibling_file in else_files]
+
+            step.probability = layer.get('probability')
+
+            step_index = len(plan.steps)
+            plan.steps.append(step)
+
+            if 'layers' in layer:
+                self._compile_layers(layer['layers'], plan)
+                step.skip = len(plan.steps) - step_index - 1
+                continue
+
+            step.path = path_join(ASSETS_DIR, layer['file'])
+            step.xy = layer.get('xy')
+            step.xy_transform = layer.get('xy_transform')
+            step.xy_data = layer.get('xy_data')
+            sibling_steps.append((step_index, layer['file']))
+
+    @staticmethod
+    def _holds(step, values):
+        """Checks if all clauses of the step hold for the predicate values."""
+
+        return all(any(values[predicate] for predicate in predicates) ==
+                   required for predicates, required in step.clauses)
+
+    def _draw_step(self, indices, step, width, height, visible=None):
+        """Composes the layer of a step onto an array of palette indices, and
+        marks its pixels in the optional array of visible ones."""
+
+        # Get the coordinates, optionally transforming them first.
+        if step.xy_transform is not None:
+            x, y = step.xy_transform(step.xy_data)
+        else:
+            x, y = step.xy
+
+        # Adjust the coordinates to be centered on the display.
+        x, y = adjust_xy(x, y, width, height)
+
+        # Skip layers entirely outside the display. The others get clipped to
+        # it when composed.
+        bounds = assets.bounds(step.path)
+        if bounds is None:
+            return
+        offset_x, offset_y, crop_width, crop_height = bounds
+        left = x + offset_x
+        top = y + offset_y
+        if left >= width or top >= height or left + crop_width <= 0 or (
+                top + crop_height <= 0):
+            return
+
+        # Draw the layer.
+        assets[step.path].compose(indices, (x, y), visible)
+
+    def _draw_layers(self, indices, values, drawn, start, end, width,
+                     height):
+        """Draws the layers of a range of steps in the render plan onto an
+        array of palette indices, drawing the ones with a probability by
+        chance."""
+
+        steps = self._plan.steps
+
+        index = start
+        while index < end:
+            step = steps[index]
+            step_index = index
+            index += 1
+
+            # Skip the step and any layers in its group unless all clauses,
+            # else conditions, and the probability hold.
+            if not self._holds(step, values):
+                index += step.skip
+                continue
+            if any(drawn[else_step] for else_step in step.else_steps):
+                index += step.skip
+                continue
+            if step.probability is not None and (
+                    step.probability <= 100 * random()):
+                index += step.skip
+                continue
+
+            # Continue with the layers in the group.
+            if step.path is None:
+                continue
+
+            self._draw_step(indices, step, width, height)
+            drawn[step_index] = True
+
+    def _static_scene(self, values, width, height):
+        """Returns the parts of the scene for the predicate values, composing
+        the runs of layers that don't depend on chance."""
+
+        key = (width, height, tuple(values))
+        with self._static_scenes_lock:
+            scene = self._static_scenes.get(key)
+        if scene is None:
+            scene = self._compose_static_scene(values, width, height)
+            with self._static_scenes_lock:
+                self._static_scenes[key] = scene
+
+        return scene
+
+    def _compose_static_scene(self, values, width, height):
+        """Splits the render plan for the predicate values into runs of layers
+        that are always drawn, which are composed into one asset each, and
+        ranges of steps that depend on chance."""
+
+        steps = self._plan.steps
+        scene = _StaticScene(width, height, len(steps))
+
+        drawn = scene.drawn
+        run = None
+        range_start = None
+
+        index = 0
+        while index < len(steps):
+            step = steps[index]
+            if not self._holds(step, values):
+                index += step.skip + 1
+                continue
+
+            # Steps with a probability or depending on one are drawn by chance,
+            # together with any layers in their group. Steps with a dynamic
+            # position are drawn on every request too.
+            if step.probability is not None or (
+                    step.xy_transform is not None) or any(
+                    drawn[else_step] is None for else_step in step.else_steps):
+                if run is not None:
+                    scene.parts.append((None, None, Asset.from_indices(*run)))
+                    run = None
+                if range_start is None:
+                    range_start = index
+                for group_index in range(index, index + step.skip + 1):
+                    drawn[group_index] = None
+                index += step.skip + 1
+                continue
+
+            if any(drawn[else_step] for else_step in step.else_steps):
+                index += step.skip + 1
+                continue
+
+            if range_start is not None:
+                scene.parts.append((range_start, index, None))
+                range_start = None
+
+            drawn[index] = True
+            index += 1
+            if step.path is None:
+                continue
+
+            # Layers before any drawn by chance go straight onto the base
+            # and later ones into a run with its visible pixels.
+            if not scene.parts:
+                self._draw_step(scene.base, step, width, height)
+                continue
+            if run is None:
+                run = (zeros((height, width), dtype=uint8),
+                       zeros((height, width), dtype=bool_))
+            run_indices, run_visible = run
+            self._draw_step(run_indices, step, width, height, run_visible)
+
+        if range_start is not None:
+            scene.parts.append((range_start, len(steps), None))
+        if run is not None:
+            scene.parts.append((None, None, Asset.from_indices(*run)))
+
+        return scene
+
+    def _draw_scene(self, user, width, height):
+        """Draws the layers of the render plan onto an array of palette
+        indices."""
+
+        # Evaluate each distinct predicate once for the whole image.
+        values = [predicate(user) for predicate in self._plan.predicates]
+
+        scene = self._static_scene(values, width, height)
+        indices = scene.base.copy()
+
+        # Dynamic steps depend on the static ones in their else conditions.
+        drawn = [bool(step_drawn) for step_drawn in scene.drawn]
+
+        for start, end, run in scene.parts:
+            if run is not None:
+                run.compose(indices, (0, 0))
+            else:
+                self._draw_layers(indices, values, drawn, start, end, width,
+                                  height)
+
+        return indices
+
+    def asset_paths(self):
+        """Lists the paths of the assets of all layers."""
+
+        return [step.path for step in self._plan.steps
+                if step.path is not None]
 
     def image(self, user, width, height, variant):
         """Generates the current city image."""
 
-        image = Image.new(mode='RGB', size=(width, height))
         try:
-            self._draw_layers(image, self._layers(), user, width, height)
+            indices = self._draw_scene(user, width, height)
         except DataError as e:
             raise ContentError(e)
 
-        # The city image is already quantized (no dithering).
-        image = image.convert('P', dither=None, palette=Image.ADAPTIVE)
+        # The city image is composed with the palette of the assets, so it's
+        # already quantized (no dithering).
+        image = Image.fromarray(indices, mode='P')
+        image.putpalette(assets.palette.tobytes())
 
         return image
@@ -0,0 +1,115 @@
+# To compile the city scene layers into a sprite atlas, which the server maps
+# into memory instead of decoding each file, run:
+# $ pip install absl-py
+# $ python compile_assets.py
+#
+# Run it again after changing any of the assets. Assets missing from the atlas
+# are decoded from their own files.
+
+from absl import app
+from absl import flags
+from json import dumps
+from os import chmod
+from os import replace
+from os import walk
+from os.path import dirname
+from os.path import join as path_join
+from PIL import Image
+from struct import pack
+from tempfile import NamedTemporaryFile
+
+from asset_store import Asset
+from asset_store import ATLAS_FILE
+from asset_store import ATLAS_HEADER_FORMAT
+from asset_store import ATLAS_MAGIC
+from asset_store import Palette
+from city import ASSETS_DIR
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string('assets_dir', ASSETS_DIR,
+                    'The directory with the image files to compile.')
+flags.DEFINE_string('output', ATLAS_FILE,
+                    'The sprite atlas file to write.')
+
+# The file extensions of the images to compile.
+IMAGE_EXTENSIONS = ('.gif', '.png')
+
+# The file permissions of the atlas, readable by the server.
+ATLAS_FILE_MODE = 0o644
+
+
+def image_files(assets_dir):
+    """Lists the paths of all image files in the directory, recursively."""
+
+    paths = []
+    for directory, _, files in walk(assets_dir):
+        for file in files:
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(path_join(directory, file))
+
+    return sorted(paths)
+
+
+def main(_):
+    # Decode the assets with a shared palette, keeping the ones that fit the
+    # atlas format.
+    palette = Palette()
+    sprites = {}
+    for path in image_files(FLAGS.assets_dir):
+        try:
+            asset = Asset.from_image(Image.open(path), palette)
+        except ValueError:
+            print('Too many colors for a shared palette: %s' % path)
+            return 1
+        if asset.indices is None:
+            print('Skipping empty image: %s' % path)
+            continue
+        mask = asset.mask
+        if mask is not None and mask.mode != '1':
+            print('Skipping image with partial transparency: %s' % path)
+            continue
+        sprites[path] = asset
+
+    # Lay out the palette indices and packed mask bits of each sprite.
+    colors = palette.tobytes()
+    table = {'palette': list(colors), 'sprites': {}}
+    data = bytearray()
+    for path, asset in sprites.items():
+        pixels_offset = len(data)
+        data += asset.indices.tobytes()
+
+        mask_offset = None
+        mask = asset.mask
+        if mask is not None:
+            mask_offset = len(data)
+            data += mask.tobytes()
+
+        crop_height, crop_width = asset.indices.shape
+        table['sprites'][path] = {
+            'width': asset.width,
+            'height': asset.height,
+            'offset': asset.offset,
+            'size': (crop_width, crop_height),
+            'pixels': pixels_offset,
+            'mask': mask_offset
+        }
+
+    # Write a new file and move it over the old one, since running servers
+    # have the old one mapped into memory and truncating it would break them.
+    table_bytes = dumps(table).encode()
+    with NamedTemporaryFile(dir=dirname(FLAGS.output) or '.',
+                            delete=False) as output_file:
+        output_file.write(pack(ATLAS_HEADER_FORMAT, ATLAS_MAGIC,
+                               len(table_bytes)))
+        output_file.write(table_bytes)
+        output_file.write(data)
+    # Temporary files are only readable by their owner.
+    chmod(output_file.name, ATLAS_FILE_MODE)
+    replace(output_file.name, FLAGS.output)
+
+    print('Wrote %d sprites with %d colors (%d bytes) to %s' % (
+        len(sprites), len(colors) // 3, len(data), FLAGS.output))
+
+
+if __name__ == '__main__':
+    app.run(main)
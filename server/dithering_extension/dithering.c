@@ -1,161 +1,995 @@
 #include <Python.h>
 #include <numpy/arrayobject.h>
+#include <pthread.h>
+#include <sched.h>
+#include <stdatomic.h>
 
 // Clamps a value to the range [0, 255].
 #define CLAMP(x) ((x) < 0 ? 0 : (x) > 255 ? 255 : (x))
 
 // Finds the closest matching color in the palette. `red`, `green`, and `blue`
 // define the input color. `palette` is an array of size `num_colors` containing
-// available RGB values. `closest_red`, `closest_green`, and `closest_blue`
-// define the output color.
-void find_closest(const uint8_t red, const uint8_t green, const uint8_t blue,
-                  const uint8_t *palette, const uint32_t num_colors,
-                  uint8_t *closest_red, uint8_t *closest_green,
-                  uint8_t *closest_blue) {
+// available RGB values. Returns the index of the closest palette color.
+uint8_t find_closest(const uint8_t red, const uint8_t green, const uint8_t blue,
+                     const uint8_t *palette, const uint32_t num_colors) {
   uint32_t min_distance = UINT32_MAX;
+  uint8_t closest = 0;
 
   // Compare to all colors in the palette and return the one with the shortest
   // Euclidean distance.
   for (uint32_t i = 0; i < num_colors; ++i) {
-    uint8_t palette_red = palette[i * 3];
-    uint8_t palette_green = palette[i * 3 + 1];
-    uint8_t palette_blue = palette[i * 3 + 2];
-
-    int32_t delta_red = (int32_t)red - palette_red;
-    int32_t delta_green = (int32_t)green - palette_green;
-    int32_t delta_blue = (int32_t)blue - palette_blue;
+    int32_t delta_red = (int32_t)red - palette[i * 3];
+    int32_t delta_green = (int32_t)green - palette[i * 3 + 1];
+    int32_t delta_blue = (int32_t)blue - palette[i * 3 + 2];
     uint32_t distance = delta_red * delta_red + delta_green * delta_green +
                         delta_blue * delta_blue;
 
     if (distance < min_distance) {
-      *closest_red = palette_red;
-      *closest_green = palette_green;
-      *closest_blue = palette_blue;
+      closest = i;
       min_distance = distance;
     }
   }
+
+  return closest;
+}
+
+// The lookup table value marking cells that span more than one palette color.
+#define LUT_AMBIGUOUS 255
+
+// A palette with an optional lookup table for finding the closest color.
+typedef struct {
+  // An array of size `num_colors` containing available RGB values.
+  const uint8_t *colors;
+  uint32_t num_colors;
+
+  // An array of size 2^`lut_bits` cubed containing the index of the closest
+  // palette color for each cell of quantized RGB values, or LUT_AMBIGUOUS if
+  // the cell needs a full search. May be NULL.
+  const uint8_t *lut;
+  uint32_t lut_bits;
+} palette_t;
+
+// Finds the index of the closest matching color in the palette, using the
+// lookup table where possible.
+static inline uint8_t closest_color(const uint8_t red, const uint8_t green,
+                                    const uint8_t blue,
+                                    const palette_t *palette) {
+  if (palette->lut) {
+    const uint32_t bits = palette->lut_bits;
+    const uint32_t shift = 8 - bits;
+    const uint8_t closest =
+        palette->lut[((red >> shift) << (2 * bits)) |
+                     ((green >> shift) << bits) | (blue >> shift)];
+    if (closest != LUT_AMBIGUOUS) {
+      return closest;
+    }
+  }
+
+  return find_closest(red, green, blue, palette->colors, palette->num_colors);
+}
+
+// Maps each pixel to the index of the closest palette color without dithering.
+// `pixels` is an array of size `num_pixels` * 3 containing RGB values.
+// `indices` is an array of size `num_pixels` that receives the palette indices.
+void map_closest(const uint8_t *pixels, const size_t num_pixels,
+                 const palette_t *palette, uint8_t *indices) {
+  for (size_t i = 0; i < num_pixels; ++i) {
+    indices[i] = closest_color(pixels[i * 3], pixels[i * 3 + 1],
+                               pixels[i * 3 + 2], palette);
+  }
+}
+
+// The number of pixels a row has to stay behind the row above it when rows are
+// dithered concurrently. Pixel (x, y) receives error from (x + 1, y - 1), and
+// the row above writes to (x + 1, y) until it has finished (x + 2, y - 1).
+#define WAVEFRONT_LAG 3
+
+// The number of pixels between progress updates published by each row.
+#define WAVEFRONT_STRIDE 16
+
+// The maximum number of threads used for dithering.
+#define MAX_THREADS 64
+
+// The maximum number of rows below a pixel that receive its error.
+#define MAX_REACH 2
+
+// The pixels that error diffusion works on. The first `height` rows are
+// dithered, and any rows up to `total_height` below them only receive error.
+// When dithering in place, `pixels` contains all the rows and `source` is
+// NULL. Otherwise, `pixels` is a ring of `num_rows` working rows, each filled
+// from `source` before it receives any error, which leaves the source
+// untouched without copying the whole image.
+typedef struct {
+  uint8_t *pixels;
+  const uint8_t *source;
+  uint32_t width;
+  uint32_t height;
+  uint32_t total_height;
+  uint32_t num_rows;
+} image_t;
+
+// Returns the working RGB values of row `y`.
+static inline uint8_t *row_pixels(const image_t *image, const uint32_t y) {
+  return image->pixels + (size_t)(y % image->num_rows) * image->width * 3;
+}
+
+// Fills the working row `y` from the source. Does nothing when dithering in
+// place or if the row is past the end of the image.
+static inline void load_row(const image_t *image, const uint32_t y) {
+  if (image->source && y < image->total_height) {
+    const size_t row_size = (size_t)image->width * 3;
+    memcpy(row_pixels(image, y), image->source + y * row_size, row_size);
+  }
+}
+
+// Replaces the pixel at offset `i` in `pixels` with the closest matching color
+// in the palette. `errors` receives the residual red, green, and blue error.
+// Returns the index of the closest palette color.
+static inline uint8_t quantize_pixel(uint8_t *pixels, const uint32_t i,
+                                     const palette_t *palette,
+                                     int32_t errors[3]) {
+  // Find the closest matching color in the palette.
+  const uint8_t old_red = pixels[i];
+  const uint8_t old_green = pixels[i + 1];
+  const uint8_t old_blue = pixels[i + 2];
+  const uint8_t closest = closest_color(old_red, old_green, old_blue, palette);
+  const uint8_t new_red = palette->colors[closest * 3];
+  const uint8_t new_green = palette->colors[closest * 3 + 1];
+  const uint8_t new_blue = palette->colors[closest * 3 + 2];
+
+  // Replace the current pixel with the closest matching color.
+  pixels[i] = new_red;
+  pixels[i + 1] = new_green;
+  pixels[i + 2] = new_blue;
+
+  // Calculate the residual error.
+  errors[0] = (int32_t)old_red - new_red;
+  errors[1] = (int32_t)old_green - new_green;
+  errors[2] = (int32_t)old_blue - new_blue;
+
+  return closest;
+}
+
+// Adds `numerator` / `denominator` of the residual `errors` to the pixel at
+// offset `i` in `pixels`.
+static inline void propagate_error(uint8_t *pixels, const uint32_t i,
+                                   const int32_t errors[3],
+                                   const int32_t numerator,
+                                   const int32_t denominator) {
+  const int32_t red_residual = pixels[i] + errors[0] * numerator / denominator;
+  pixels[i] = CLAMP(red_residual);
+  const int32_t green_residual =
+      pixels[i + 1] + errors[1] * numerator / denominator;
+  pixels[i + 1] = CLAMP(green_residual);
+  const int32_t blue_residual =
+      pixels[i + 2] + errors[2] * numerator / denominator;
+  pixels[i + 2] = CLAMP(blue_residual);
+}
+
+// Quantizes pixel `x` of `row` to the closest palette color and diffuses the
+// residual error to its neighbors in `row` and `next_row` using the
+// Floyd-Steinberg weights. `next_row` is NULL for the last row. If
+// `row_indices` is not NULL, it receives the palette index of the pixel.
+static inline void diffuse_pixel(uint8_t *row, uint8_t *next_row,
+                                 const uint32_t x, const uint32_t width,
+                                 const palette_t *palette,
+                                 uint8_t *row_indices) {
+  int32_t errors[3];
+  const uint8_t closest = quantize_pixel(row, x * 3, palette, errors);
+  if (row_indices) {
+    row_indices[x] = closest;
+  }
+
+  // Propagate 7/16 of the residual error to (x + 1, y).
+  if (x < width - 1) {
+    propagate_error(row, (x + 1) * 3, errors, 7, 16);
+  }
+
+  if (next_row) {
+    // Propagate 3/16 of the residual error to (x - 1, y + 1).
+    if (x > 0) {
+      propagate_error(next_row, (x - 1) * 3, errors, 3, 16);
+    }
+
+    // Propagate 5/16 of the residual error to (x, y + 1).
+    propagate_error(next_row, x * 3, errors, 5, 16);
+
+    // Propagate 1/16 of the residual error to (x + 1, y + 1).
+    if (x < width - 1) {
+      propagate_error(next_row, (x + 1) * 3, errors, 1, 16);
+    }
+  }
 }
 
-// Runs the Floyd-Steinberg dithering algorithm on the image. `pixels` is an
-// array of size `width` * `height` * 3 containing RGB values in row-major
-// order. `palette` is an array of size `num_colors` containing available RGB
-// values. The pixels are modified in place.
-void floyd_steinberg(uint8_t *pixels, const uint32_t width,
-                     const uint32_t height, const uint8_t *palette,
-                     const uint32_t num_colors) {
+// Runs the Floyd-Steinberg dithering algorithm on the image. `palette`
+// contains the available colors. If `indices` is not NULL, it is an array of
+// size `width` * `height` that receives the palette index of each pixel in
+// row-major order.
+void floyd_steinberg(const image_t *image, const palette_t *palette,
+                     uint8_t *indices) {
+  const uint32_t width = image->width;
+  const uint32_t height = image->height;
+  const uint32_t total_height = image->total_height;
   for (uint32_t y = 0; y < height; ++y) {
+    load_row(image, y + 1);
+    uint8_t *row = row_pixels(image, y);
+    uint8_t *next_row = y + 1 < total_height ? row_pixels(image, y + 1) : NULL;
+    uint8_t *row_indices = indices ? indices + (size_t)y * width : NULL;
     for (uint32_t x = 0; x < width; ++x) {
-      uint32_t i = (y * width + x) * 3;
-
-      // Find the closest matching color in the palette.
-      const uint8_t old_red = pixels[i];
-      const uint8_t old_green = pixels[i + 1];
-      const uint8_t old_blue = pixels[i + 2];
-      uint8_t new_red, new_green, new_blue;
-      find_closest(old_red, old_green, old_blue, palette, num_colors, &new_red,
-                   &new_green, &new_blue);
-
-      // Replace the current pixel with the closest matching color.
-      pixels[i] = new_red;
-      pixels[i + 1] = new_green;
-      pixels[i + 2] = new_blue;
-
-      // Calculate the residual error.
-      const int32_t red_error = (int32_t)old_red - new_red;
-      const int32_t green_error = (int32_t)old_green - new_green;
-      const int32_t blue_error = (int32_t)old_blue - new_blue;
-      int32_t red_residual, green_residual, blue_residual;
-
-      // Propagate 7/16 of the residual error to (x + 1, y).
+      diffuse_pixel(row, next_row, x, width, palette, row_indices);
+    }
+  }
+}
+
+// Runs the Atkinson dithering algorithm on the image. It diffuses only 6/8 of
+// the residual error, which keeps more contrast in flat areas such as text. The
+// arguments are the same as for floyd_steinberg().
+void atkinson(const image_t *image, const palette_t *palette,
+              uint8_t *indices) {
+  const uint32_t width = image->width;
+  const uint32_t height = image->height;
+  const uint32_t total_height = image->total_height;
+  for (uint32_t y = 0; y < height; ++y) {
+    load_row(image, y + 2);
+    uint8_t *row = row_pixels(image, y);
+    uint8_t *next_row = y + 1 < total_height ? row_pixels(image, y + 1) : NULL;
+    uint8_t *row_after_next =
+        y + 2 < total_height ? row_pixels(image, y + 2) : NULL;
+    for (uint32_t x = 0; x < width; ++x) {
+      int32_t errors[3];
+      const uint8_t closest = quantize_pixel(row, x * 3, palette, errors);
+      if (indices) {
+        indices[(size_t)y * width + x] = closest;
+      }
+
+      // Propagate 1/8 of the residual error to (x + 1, y) and (x + 2, y).
       if (x < width - 1) {
-        i = (y * width + (x + 1)) * 3;
-        red_residual = pixels[i] + red_error * 7 / 16;
-        pixels[i] = CLAMP(red_residual);
-        green_residual = pixels[i + 1] + green_error * 7 / 16;
-        pixels[i + 1] = CLAMP(green_residual);
-        blue_residual = pixels[i + 2] + blue_error * 7 / 16;
-        pixels[i + 2] = CLAMP(blue_residual);
+        propagate_error(row, (x + 1) * 3, errors, 1, 8);
+      }
+      if (x + 2 < width) {
+        propagate_error(row, (x + 2) * 3, errors, 1, 8);
+      }
+
+      // Propagate 1/8 of the residual error to (x - 1, y + 1), (x, y + 1),
+      // and (x + 1, y + 1).
+      if (next_row) {
+        if (x > 0) {
+          propagate_error(next_row, (x - 1) * 3, errors, 1, 8);
+        }
+        propagate_error(next_row, x * 3, errors, 1, 8);
+        if (x < width - 1) {
+          propagate_error(next_row, (x + 1) * 3, errors, 1, 8);
+        }
+      }
+
+      // Propagate 1/8 of the residual error to (x, y + 2).
+      if (row_after_next) {
+        propagate_error(row_after_next, x * 3, errors, 1, 8);
       }
+    }
+  }
+}
+
+// The state shared by all threads of a wavefront dithering run.
+typedef struct {
+  const image_t *image;
+  const palette_t *palette;
+  uint8_t *indices;
 
-      // Propagate 3/16 of the residual error to (x - 1, y + 1).
-      if (x > 0 && y < height - 1) {
-        i = ((y + 1) * width + (x - 1)) * 3;
-        red_residual = pixels[i] + red_error * 3 / 16;
-        pixels[i] = CLAMP(red_residual);
-        green_residual = pixels[i + 1] + green_error * 3 / 16;
-        pixels[i + 1] = CLAMP(green_residual);
-        blue_residual = pixels[i + 2] + blue_error * 3 / 16;
-        pixels[i + 2] = CLAMP(blue_residual);
+  // The next row that has not been claimed by any thread.
+  atomic_uint next_row;
+
+  // The number of finished pixels in each row.
+  atomic_uint *progress;
+} wavefront_t;
+
+// Waits until row `y` has finished at least `needed` pixels. `ready` is the
+// progress last seen and is updated. Returns the new progress.
+static inline uint32_t wait_for_row(wavefront_t *wavefront, const uint32_t y,
+                                    uint32_t ready, const uint32_t needed) {
+  while (ready < needed) {
+    ready = atomic_load_explicit(&wavefront->progress[y],
+                                 memory_order_acquire);
+    if (ready < needed) {
+      sched_yield();
+    }
+  }
+  return ready;
+}
+
+// Claims and dithers rows until none are left. Each row waits for the row above
+// it to stay at least WAVEFRONT_LAG pixels ahead, which applies the error
+// diffusion in the same order as floyd_steinberg().
+static void *wavefront_worker(void *arg) {
+  wavefront_t *wavefront = arg;
+  const image_t *image = wavefront->image;
+  const uint32_t width = image->width;
+  const uint32_t height = image->height;
+  const uint32_t total_height = image->total_height;
+
+  while (1) {
+    const uint32_t y = atomic_fetch_add(&wavefront->next_row, 1);
+    if (y >= height) {
+      break;
+    }
+
+    // Load the row below into the working row of a row that has finished.
+    // With at most num_rows - 1 rows in flight, it already has, but waiting
+    // for it makes its last writes visible to this thread.
+    if (image->source && y + 1 < total_height) {
+      if (y + 1 >= image->num_rows) {
+        wait_for_row(wavefront, y + 1 - image->num_rows, 0, width);
       }
+      load_row(image, y + 1);
+    }
 
-      // Propagate 5/16 of the residual error to (x, y + 1).
-      if (y < height - 1) {
-        i = ((y + 1) * width + x) * 3;
-        red_residual = pixels[i] + red_error * 5 / 16;
-        pixels[i] = CLAMP(red_residual);
-        green_residual = pixels[i + 1] + green_error * 5 / 16;
-        pixels[i + 1] = CLAMP(green_residual);
-        blue_residual = pixels[i + 2] + blue_error * 5 / 16;
-        pixels[i + 2] = CLAMP(blue_residual);
+    uint8_t *row = row_pixels(image, y);
+    uint8_t *next_row = y + 1 < total_height ? row_pixels(image, y + 1) : NULL;
+    uint8_t *row_indices =
+        wavefront->indices ? wavefront->indices + (size_t)y * width : NULL;
+
+    // The first row does not depend on any other row.
+    uint32_t ready = y == 0 ? width : 0;
+    for (uint32_t x = 0; x < width; ++x) {
+      // Wait until the row above is far enough ahead.
+      if (y > 0) {
+        ready = wait_for_row(
+            wavefront, y - 1, ready,
+            x + WAVEFRONT_LAG < width ? x + WAVEFRONT_LAG : width);
       }
 
-      // Propagate 1/16 of the residual error to (x + 1, y + 1).
-      if (x < width - 1 && y < height - 1) {
-        i = ((y + 1) * width + (x + 1)) * 3;
-        red_residual = pixels[i] + red_error / 16;
-        pixels[i] = CLAMP(red_residual);
-        green_residual = pixels[i + 1] + green_error / 16;
-        pixels[i + 1] = CLAMP(green_residual);
-        blue_residual = pixels[i + 2] + blue_error / 16;
-        pixels[i + 2] = CLAMP(blue_residual);
+      diffuse_pixel(row, next_row, x, width, wavefront->palette, row_indices);
+
+      // Periodically let the row below know how far this row has come.
+      if ((x + 1) % WAVEFRONT_STRIDE == 0) {
+        atomic_store_explicit(&wavefront->progress[y], x + 1,
+                              memory_order_release);
       }
     }
+    atomic_store_explicit(&wavefront->progress[y], width,
+                          memory_order_release);
+  }
+
+  return NULL;
+}
+
+// Runs the Floyd-Steinberg dithering algorithm on the image using
+// `num_threads` threads, each working on a different row. A ring of working
+// rows needs room for `num_threads` + 1 rows. The output is identical to
+// floyd_steinberg(), which has the same other arguments. Returns 0 if memory
+// could not be allocated.
+int floyd_steinberg_wavefront(const image_t *image, const palette_t *palette,
+                              uint8_t *indices, const uint32_t num_threads) {
+  if (num_threads <= 1) {
+    floyd_steinberg(image, palette, indices);
+    return 1;
+  }
+
+  wavefront_t wavefront;
+  wavefront.image = image;
+  wavefront.palette = palette;
+  wavefront.indices = indices;
+  atomic_init(&wavefront.next_row, 0);
+  wavefront.progress = malloc(image->height * sizeof(atomic_uint));
+  if (!wavefront.progress) {
+    return 0;
+  }
+  for (uint32_t y = 0; y < image->height; ++y) {
+    atomic_init(&wavefront.progress[y], 0);
+  }
+
+  // Start the helper threads. Rows are claimed dynamically, so the calling
+  // thread finishes the work even if some threads fail to start.
+  pthread_t threads[MAX_THREADS];
+  uint32_t num_started = 0;
+  for (uint32_t i = 1; i < num_threads; ++i) {
+    if (pthread_create(&threads[num_started], NULL, wavefront_worker,
+                       &wavefront) != 0) {
+      break;
+    }
+    ++num_started;
+  }
+
+  wavefront_worker(&wavefront);
+  for (uint32_t i = 0; i < num_started; ++i) {
+    pthread_join(threads[i], NULL);
+  }
+
+  free(wavefront.progress);
+  return 1;
+}
+
+// Packs palette indices into the display's bit stream. `indices` is an array
+// of size `num_pixels` containing palette indices. `codes` is an array of size
+// `num_colors` containing the `bits_per_pixel` wide code of each palette
+// color. `output` receives the codes most significant bit first, with the last
+// byte padded with zeros. Returns 0 if an index is out of range.
+int pack_indices(const uint8_t *indices, const size_t num_pixels,
+                 const uint8_t *codes, const uint32_t num_colors,
+                 const uint32_t bits_per_pixel, uint8_t *output) {
+  uint32_t accumulator = 0;
+  uint32_t num_bits = 0;
+
+  for (size_t i = 0; i < num_pixels; ++i) {
+    const uint8_t index = indices[i];
+    if (index >= num_colors) {
+      return 0;
+    }
+
+    // Append the code and flush any complete bytes.
+    accumulator = (accumulator << bits_per_pixel) | codes[index];
+    num_bits += bits_per_pixel;
+    while (num_bits >= 8) {
+      num_bits -= 8;
+      *output++ = (uint8_t)(accumulator >> num_bits);
+    }
+    accumulator &= (1u << num_bits) - 1;
+  }
+
+  // Pad the remaining bits of the last byte with zeros.
+  if (num_bits > 0) {
+    *output = (uint8_t)(accumulator << (8 - num_bits));
+  }
+
+  return 1;
+}
+
+// The longest sequence of literal or repeated bytes in the run-length encoding.
+#define RLE_MAX_COUNT 128
+
+// Compresses `size` bytes of `data` with the PackBits run-length encoding. A
+// header byte h below 128 is followed by h + 1 literal bytes, and a header
+// byte h above 128 is followed by one byte that repeats 257 - h times.
+// `output` needs room for `size` + `size` / RLE_MAX_COUNT + 1 bytes. Returns
+// the number of bytes written.
+size_t run_length_encode(const uint8_t *data, const size_t size,
+                         uint8_t *output) {
+  size_t i = 0;
+  uint8_t *start = output;
+
+  while (i < size) {
+    // Encode a run of at least 2 equal bytes as a repeated byte.
+    size_t count = 1;
+    while (i + count < size && count < RLE_MAX_COUNT &&
+           data[i + count] == data[i]) {
+      ++count;
+    }
+    if (count >= 2) {
+      *output++ = (uint8_t)(257 - count);
+      *output++ = data[i];
+      i += count;
+      continue;
+    }
+
+    // Collect literal bytes until the next run of at least 3 equal bytes,
+    // which is shorter to encode as a repeated byte.
+    count = 1;
+    while (i + count < size && count < RLE_MAX_COUNT &&
+           !(i + count + 2 < size && data[i + count] == data[i + count + 1] &&
+             data[i + count] == data[i + count + 2])) {
+      ++count;
+    }
+    *output++ = (uint8_t)(count - 1);
+    memcpy(output, data + i, count);
+    output += count;
+    i += count;
+  }
+
+  return output - start;
+}
+
+// The error diffusion algorithms available to the dithering entry points.
+typedef enum { FLOYD_STEINBERG, ATKINSON } algorithm_t;
+
+// Runs the specified dithering algorithm on the image. If `image->source` is
+// not NULL, the working rows are allocated here. If `carry` is not NULL, it
+// is an array of MAX_REACH rows that replaces the first rows of the source on
+// entry and receives the working rows below the dithered ones on return, which
+// lets the caller dither an image in bands. If `indices` is not NULL, it
+// receives the palette index of each pixel. Only Floyd-Steinberg uses
+// multiple threads. Returns 0 if memory could not be allocated.
+static int run_algorithm(const algorithm_t algorithm, image_t *image,
+                         uint8_t *carry, const palette_t *palette,
+                         uint8_t *indices, uint32_t num_threads) {
+  if (image->width == 0 || image->height == 0) {
+    return 1;
+  }
+  if (algorithm != FLOYD_STEINBERG || num_threads < 1) {
+    num_threads = 1;
+  }
+  if (num_threads > MAX_THREADS) {
+    num_threads = MAX_THREADS;
+  }
+  if (num_threads > image->height) {
+    num_threads = image->height;
+  }
+
+  // Make room for each row in flight and the rows below it that receive its
+  // error, and fill the rows that receive error before the algorithm starts
+  // loading rows.
+  const size_t row_size = (size_t)image->width * 3;
+  const uint32_t reach = algorithm == ATKINSON ? 2 : 1;
+  if (image->source) {
+    image->num_rows = num_threads + reach;
+    image->pixels = malloc(image->num_rows * row_size);
+    if (!image->pixels) {
+      return 0;
+    }
+    for (uint32_t y = 0; y < reach; ++y) {
+      load_row(image, y);
+    }
+  } else {
+    image->num_rows = image->total_height;
+  }
+  if (carry) {
+    for (uint32_t y = 0; y < reach && y < image->total_height; ++y) {
+      memcpy(row_pixels(image, y), carry + y * row_size, row_size);
+    }
+  }
+
+  int success = 1;
+  switch (algorithm) {
+    case ATKINSON:
+      atkinson(image, palette, indices);
+      break;
+    case FLOYD_STEINBERG:
+    default:
+      success = floyd_steinberg_wavefront(image, palette, indices,
+                                          num_threads);
+      break;
+  }
+
+  // Hand the error diffused below the dithered rows back to the caller.
+  if (success && carry) {
+    for (uint32_t i = 0; i < reach && image->height + i < image->total_height;
+         ++i) {
+      memcpy(carry + i * row_size, row_pixels(image, image->height + i),
+             row_size);
+    }
+  }
+
+  if (image->source) {
+    free(image->pixels);
+  }
+  return success;
+}
+
+// Gets the pixels from any object supporting the buffer protocol, such as a
+// numpy array or a memoryview, without copying them. `flags` may add
+// PyBUF_WRITABLE. The buffer must be a C-contiguous array of uint8 of shape
+// (height, width, 3). `name` describes the argument in error messages.
+// Returns 0 and sets a Python exception on failure. Otherwise, the caller must
+// release `view`.
+static int get_pixels(PyObject *object, const int flags, const char *name,
+                      Py_buffer *view) {
+  if (PyObject_GetBuffer(object, view,
+                         PyBUF_C_CONTIGUOUS | PyBUF_FORMAT | flags) != 0) {
+    return 0;
+  }
+
+  // Verify that the buffer is of the correct shape and type. Skip the byte
+  // order character of the format, which doesn't matter for single bytes.
+  const char *format = view->format ? view->format : "B";
+  if (*format && strchr("@=<>!", *format)) {
+    ++format;
+  }
+  if (view->ndim != 3 || view->shape[2] != 3) {
+    PyErr_Format(PyExc_ValueError,
+                 "%s should be a buffer of shape (height, width, 3)", name);
+    PyBuffer_Release(view);
+    return 0;
+  }
+  if (view->itemsize != 1 || strcmp(format, "B") != 0) {
+    PyErr_Format(PyExc_ValueError, "%s should be of type uint8", name);
+    PyBuffer_Release(view);
+    return 0;
+  }
+
+  return 1;
+}
+
+// Validates the palette array and fills in `palette` from it and the optional
+// lookup table object. Returns 0 and sets a Python exception on failure.
+static int validate_palette(PyArrayObject *palette_array, PyObject *lut_object,
+                            palette_t *palette) {
+  // Verify that the palette is of the correct shape, type, and memory layout.
+  if (PyArray_NDIM(palette_array) != 2 || PyArray_DIM(palette_array, 1) != 3) {
+    PyErr_SetString(PyExc_ValueError,
+                    "Palette should be a numpy array of shape (num_colors, 3)");
+    return 0;
+  }
+  if (PyArray_DIM(palette_array, 0) < 1 ||
+      PyArray_DIM(palette_array, 0) > 256) {
+    PyErr_SetString(PyExc_ValueError,
+                    "Palette should have between 1 and 256 colors");
+    return 0;
+  }
+  if (PyArray_TYPE(palette_array) != NPY_UINT8) {
+    PyErr_SetString(PyExc_ValueError, "Palette should be of type uint8");
+    return 0;
+  }
+  if (!PyArray_IS_C_CONTIGUOUS(palette_array)) {
+    PyErr_SetString(PyExc_ValueError, "Palette should be C-contiguous");
+    return 0;
+  }
+
+  palette->colors = PyArray_DATA(palette_array);
+  palette->num_colors = PyArray_DIM(palette_array, 0);
+  palette->lut = NULL;
+  palette->lut_bits = 0;
+  if (!lut_object || lut_object == Py_None) {
+    return 1;
+  }
+
+  // Verify that the lookup table is a cube with a power of 2 side length.
+  if (!PyArray_Check(lut_object)) {
+    PyErr_SetString(PyExc_ValueError, "Lookup table should be a numpy array");
+    return 0;
+  }
+  PyArrayObject *lut = (PyArrayObject *)lut_object;
+  uint32_t lut_bits = 0;
+  if (PyArray_NDIM(lut) == 3) {
+    while (lut_bits < 8 && (1 << lut_bits) < PyArray_DIM(lut, 0)) {
+      ++lut_bits;
+    }
+  }
+  if (PyArray_NDIM(lut) != 3 || PyArray_DIM(lut, 0) != (1 << lut_bits) ||
+      PyArray_DIM(lut, 1) != (1 << lut_bits) ||
+      PyArray_DIM(lut, 2) != (1 << lut_bits)) {
+    PyErr_SetString(PyExc_ValueError,
+                    "Lookup table should be a numpy array of shape (2^bits, "
+                    "2^bits, 2^bits) with bits between 0 and 8");
+    return 0;
+  }
+  if (PyArray_TYPE(lut) != NPY_UINT8 || !PyArray_IS_C_CONTIGUOUS(lut)) {
+    PyErr_SetString(PyExc_ValueError,
+                    "Lookup table should be a C-contiguous array of uint8");
+    return 0;
+  }
+  if (palette->num_colors > LUT_AMBIGUOUS) {
+    PyErr_SetString(PyExc_ValueError,
+                    "Lookup tables support at most 255 palette colors");
+    return 0;
+  }
+
+  palette->lut = PyArray_DATA(lut);
+  palette->lut_bits = lut_bits;
+  return 1;
+}
+
+// Parses and validates the pixels, palette, threads, algorithm, and lookup
+// table arguments shared by the dithering entry points. `flags` are passed to
+// get_pixels(). If `rows` and `carry` are not NULL, also parses the arguments
+// for dithering in bands: the number of rows to dither, which defaults to all
+// of them, and the optional carry buffer, whose `buf` is NULL if missing.
+// Returns 0 and sets a Python exception on failure. Otherwise, the caller must
+// release `pixels` and `carry`.
+static int parse_dither_arguments(PyObject *args, PyObject *kwargs,
+                                  const int flags, Py_buffer *pixels,
+                                  palette_t *palette, uint32_t *num_threads,
+                                  algorithm_t *algorithm, uint32_t *rows,
+                                  Py_buffer *carry) {
+  static char *keywords[] = {"pixels", "palette", "threads", "algorithm",
+                             "lut", NULL};
+  static char *band_keywords[] = {"pixels", "palette", "threads", "algorithm",
+                                  "lut", "rows", "carry", NULL};
+  PyObject *pixels_object;
+  PyArrayObject *palette_array;
+  const char *algorithm_name = "floyd-steinberg";
+  PyObject *lut = NULL;
+  PyObject *rows_object = Py_None;
+  PyObject *carry_object = Py_None;
+  *num_threads = 1;
+  int parsed;
+  if (carry) {
+    parsed = PyArg_ParseTupleAndKeywords(
+        args, kwargs, "OO!|IsOOO", band_keywords, &pixels_object,
+        &PyArray_Type, &palette_array, num_threads, &algorithm_name, &lut,
+        &rows_object, &carry_object);
+  } else {
+    parsed = PyArg_ParseTupleAndKeywords(
+        args, kwargs, "OO!|IsO", keywords, &pixels_object, &PyArray_Type,
+        &palette_array, num_threads, &algorithm_name, &lut);
+  }
+  if (!parsed) {
+    return 0;
+  }
+
+  // Look up the algorithm by name.
+  if (strcmp(algorithm_name, "floyd-steinberg") == 0) {
+    *algorithm = FLOYD_STEINBERG;
+  } else if (strcmp(algorithm_name, "atkinson") == 0) {
+    *algorithm = ATKINSON;
+  } else {
+    PyErr_Format(PyExc_ValueError, "Unsupported dithering algorithm: %s",
+                 algorithm_name);
+    return 0;
+  }
+
+  if (!validate_palette(palette_array, lut, palette)) {
+    return 0;
+  }
+  if (!get_pixels(pixels_object, flags, "Pixels", pixels)) {
+    return 0;
+  }
+  if (!carry) {
+    return 1;
+  }
+
+  // Verify that the number of rows to dither fits within the pixels.
+  *rows = pixels->shape[0];
+  if (rows_object != Py_None) {
+    const long value = PyLong_AsLong(rows_object);
+    if (value == -1 && PyErr_Occurred()) {
+      PyBuffer_Release(pixels);
+      return 0;
+    }
+    if (value < 0 || value > pixels->shape[0]) {
+      PyErr_SetString(PyExc_ValueError,
+                      "Rows should be between 0 and the height of the pixels");
+      PyBuffer_Release(pixels);
+      return 0;
+    }
+    *rows = value;
+  }
+
+  // Verify that the carry buffer holds the rows below a band.
+  if (carry_object == Py_None) {
+    carry->buf = NULL;
+    carry->obj = NULL;
+    return 1;
+  }
+  if (!get_pixels(carry_object, PyBUF_WRITABLE, "Carry", carry)) {
+    PyBuffer_Release(pixels);
+    return 0;
+  }
+  if (carry->shape[0] != MAX_REACH || carry->shape[1] != pixels->shape[1]) {
+    PyErr_SetString(PyExc_ValueError,
+                    "Carry should be a buffer of shape (2, width, 3)");
+    PyBuffer_Release(carry);
+    PyBuffer_Release(pixels);
+    return 0;
+  }
+
+  return 1;
+}
+
+static PyObject *dither(PyObject *self, PyObject *args, PyObject *kwargs) {
+  // Parse the function arguments.
+  Py_buffer pixels;
+  palette_t palette;
+  uint32_t num_threads;
+  algorithm_t algorithm;
+  if (!parse_dither_arguments(args, kwargs, PyBUF_WRITABLE, &pixels, &palette,
+                              &num_threads, &algorithm, NULL, NULL)) {
+    return NULL;
+  }
+
+  // Get the dimensions from the buffer.
+  image_t image;
+  image.pixels = pixels.buf;
+  image.source = NULL;
+  image.width = pixels.shape[1];
+  image.height = pixels.shape[0];
+  image.total_height = image.height;
+
+  // Run the dithering algorithm in place without holding the GIL.
+  int success;
+  Py_BEGIN_ALLOW_THREADS
+  success = run_algorithm(algorithm, &image, NULL, &palette, NULL,
+                          num_threads);
+  Py_END_ALLOW_THREADS
+  PyBuffer_Release(&pixels);
+  if (!success) {
+    return PyErr_NoMemory();
+  }
+
+  Py_RETURN_NONE;
+}
+
+static PyObject *dither_indices(PyObject *self, PyObject *args,
+                                PyObject *kwargs) {
+  // Parse the function arguments. The pixels are only read, so they may be a
+  // read-only buffer.
+  Py_buffer pixels;
+  palette_t palette;
+  uint32_t num_threads;
+  algorithm_t algorithm;
+  uint32_t rows;
+  Py_buffer carry;
+  if (!parse_dither_arguments(args, kwargs, 0, &pixels, &palette,
+                              &num_threads, &algorithm, &rows, &carry)) {
+    return NULL;
+  }
+
+  // Dither the first rows of the pixels, letting the rows below them receive
+  // the error.
+  image_t image;
+  image.pixels = NULL;
+  image.source = pixels.buf;
+  image.width = pixels.shape[1];
+  image.height = rows;
+  image.total_height = pixels.shape[0];
+
+  // Allocate the output array of palette indices.
+  npy_intp dims[2] = {image.height, image.width};
+  PyArrayObject *indices =
+      (PyArrayObject *)PyArray_SimpleNew(2, dims, NPY_UINT8);
+  if (!indices) {
+    PyBuffer_Release(&carry);
+    PyBuffer_Release(&pixels);
+    return NULL;
+  }
+
+  // Run the dithering algorithm without holding the GIL, recording the
+  // indices along the way.
+  int success;
+  Py_BEGIN_ALLOW_THREADS
+  success = run_algorithm(algorithm, &image, carry.buf, &palette,
+                          PyArray_DATA(indices), num_threads);
+  Py_END_ALLOW_THREADS
+  PyBuffer_Release(&carry);
+  PyBuffer_Release(&pixels);
+  if (!success) {
+    Py_DECREF(indices);
+    return PyErr_NoMemory();
+  }
+
+  return (PyObject *)indices;
+}
+
+static PyObject *closest_indices(PyObject *self, PyObject *args,
+                                 PyObject *kwargs) {
+  // Parse the function arguments.
+  static char *keywords[] = {"pixels", "palette", "lut", NULL};
+  PyObject *pixels_object;
+  PyArrayObject *palette_array;
+  PyObject *lut = NULL;
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO!|O", keywords,
+                                   &pixels_object, &PyArray_Type,
+                                   &palette_array, &lut)) {
+    return NULL;
+  }
+  palette_t palette;
+  if (!validate_palette(palette_array, lut, &palette)) {
+    return NULL;
+  }
+  Py_buffer pixels;
+  if (!get_pixels(pixels_object, 0, "Pixels", &pixels)) {
+    return NULL;
+  }
+
+  // Allocate the output array of palette indices.
+  npy_intp dims[2] = {pixels.shape[0], pixels.shape[1]};
+  PyArrayObject *indices =
+      (PyArrayObject *)PyArray_SimpleNew(2, dims, NPY_UINT8);
+  if (!indices) {
+    PyBuffer_Release(&pixels);
+    return NULL;
   }
+
+  // Map the pixels without holding the GIL.
+  Py_BEGIN_ALLOW_THREADS
+  map_closest(pixels.buf, PyArray_SIZE(indices), &palette,
+              PyArray_DATA(indices));
+  Py_END_ALLOW_THREADS
+  PyBuffer_Release(&pixels);
+
+  return (PyObject *)indices;
 }
 
-static PyObject *dither(PyObject *self, PyObject *args) {
+static PyObject *pack(PyObject *self, PyObject *args) {
   // Parse the function arguments.
-  PyArrayObject *pixels, *palette;
-  if (!PyArg_ParseTuple(args, "O!O!", &PyArray_Type, &pixels, &PyArray_Type,
-                        &palette)) {
+  PyObject *indices_object;
+  PyArrayObject *encoding;
+  if (!PyArg_ParseTuple(args, "OO!", &indices_object, &PyArray_Type,
+                        &encoding)) {
     return NULL;
   }
 
-  // Verify that the inputs are of the correct shape.
-  if (PyArray_NDIM(pixels) != 3 || PyArray_DIM(pixels, 2) != 3) {
+  // Verify that the encoding is of the correct shape and type.
+  if (PyArray_NDIM(encoding) != 2 || PyArray_DIM(encoding, 0) < 1 ||
+      PyArray_DIM(encoding, 0) > 256 || PyArray_DIM(encoding, 1) < 1 ||
+      PyArray_DIM(encoding, 1) > 8) {
     PyErr_SetString(
         PyExc_ValueError,
-        "Pixels should be a numpy array of shape (height, width, 3)");
+        "Encoding should be a numpy array of shape (num_colors, num_bits)");
     return NULL;
   }
-  if (PyArray_NDIM(palette) != 2 || PyArray_DIM(palette, 1) != 3) {
-    PyErr_SetString(PyExc_ValueError,
-                    "Palette should be a numpy array of shape (num_colors, 3)");
+  if (PyArray_TYPE(encoding) != NPY_UINT8) {
+    PyErr_SetString(PyExc_ValueError, "Encoding should be of type uint8");
     return NULL;
   }
 
-  // Verify that the inputs are of the correct type.
-  if (PyArray_TYPE(pixels) != NPY_UINT8 || PyArray_TYPE(palette) != NPY_UINT8) {
-    PyErr_SetString(PyExc_ValueError,
-                    "Pixels and palette should be of type uint8");
+  // Convert the encoding bits into one code per palette color.
+  uint32_t num_colors = PyArray_DIM(encoding, 0);
+  uint32_t bits_per_pixel = PyArray_DIM(encoding, 1);
+  uint8_t codes[256];
+  for (uint32_t i = 0; i < num_colors; ++i) {
+    codes[i] = 0;
+    for (uint32_t j = 0; j < bits_per_pixel; ++j) {
+      const uint8_t bit = *(uint8_t *)PyArray_GETPTR2(encoding, i, j);
+      codes[i] = (codes[i] << 1) | (bit ? 1 : 0);
+    }
+  }
+
+  // Get a contiguous view of the indices, casting them to uint8 if needed.
+  PyArrayObject *indices = (PyArrayObject *)PyArray_FROMANY(
+      indices_object, NPY_UINT8, 0, 0, NPY_ARRAY_C_CONTIGUOUS |
+      NPY_ARRAY_ALIGNED | NPY_ARRAY_FORCECAST);
+  if (!indices) {
     return NULL;
   }
 
-  // Get the dimensions from the numpy arrays.
-  uint32_t height = PyArray_DIM(pixels, 0);
-  uint32_t width = PyArray_DIM(pixels, 1);
-  uint32_t num_colors = PyArray_DIM(palette, 0);
+  // Allocate the output bytes and pack the indices straight into them.
+  size_t num_pixels = PyArray_SIZE(indices);
+  size_t num_bytes = (num_pixels * bits_per_pixel + 7) / 8;
+  PyObject *output = PyBytes_FromStringAndSize(NULL, num_bytes);
+  if (!output) {
+    Py_DECREF(indices);
+    return NULL;
+  }
+  int success = pack_indices(PyArray_DATA(indices), num_pixels, codes,
+                             num_colors, bits_per_pixel,
+                             (uint8_t *)PyBytes_AS_STRING(output));
+  Py_DECREF(indices);
+  if (!success) {
+    Py_DECREF(output);
+    PyErr_SetString(PyExc_ValueError, "Index out of range of the encoding");
+    return NULL;
+  }
 
-  // Run the Floyd-Steinberg algorithm.
-  floyd_steinberg(PyArray_DATA(pixels), width, height, PyArray_DATA(palette),
-                  num_colors);
+  return output;
+}
 
-  Py_RETURN_NONE;
+static PyObject *encode_rle(PyObject *self, PyObject *args) {
+  // Parse the function arguments.
+  Py_buffer data;
+  if (!PyArg_ParseTuple(args, "y*", &data)) {
+    return NULL;
+  }
+
+  // Allocate room for the worst case and shrink the output to fit afterwards.
+  const size_t size = data.len;
+  PyObject *output =
+      PyBytes_FromStringAndSize(NULL, size + size / RLE_MAX_COUNT + 1);
+  if (!output) {
+    PyBuffer_Release(&data);
+    return NULL;
+  }
+
+  // Encode the data without holding the GIL.
+  size_t output_size;
+  Py_BEGIN_ALLOW_THREADS
+  output_size = run_length_encode(data.buf, size,
+                                  (uint8_t *)PyBytes_AS_STRING(output));
+  Py_END_ALLOW_THREADS
+  PyBuffer_Release(&data);
+  if (_PyBytes_Resize(&output, output_size) != 0) {
+    return NULL;
+  }
+
+  return output;
 }
 
 static PyMethodDef package_methods[] = {
-    {"dither", dither, METH_VARARGS,
-     "Dithers the image in place using the Floyd-Steinberg algorithm."},
+    {"dither", (PyCFunction)dither, METH_VARARGS | METH_KEYWORDS,
+     "Dithers the image in place using the Floyd-Steinberg (default) or "
+     "Atkinson algorithm."},
+    {"dither_indices", (PyCFunction)dither_indices,
+     METH_VARARGS | METH_KEYWORDS,
+     "Dithers the image using the Floyd-Steinberg (default) or Atkinson "
+     "algorithm without modifying it and returns the palette index of each "
+     "pixel. Dithers only the first `rows` rows if specified, and uses and "
+     "updates the `carry` buffer of the 2 rows below them if specified, which "
+     "allows dithering the image in bands."},
+    {"closest_indices", (PyCFunction)closest_indices,
+     METH_VARARGS | METH_KEYWORDS,
+     "Returns the index of the closest palette color for each pixel."},
+    {"pack", pack, METH_VARARGS,
+     "Packs palette indices into bytes using the bit encoding of each color."},
+    {"encode_rle", encode_rle, METH_VARARGS,
+     "Compresses bytes with the PackBits run-length encoding."},
     {NULL, NULL, 0, NULL}};
 
 static struct PyModuleDef package_definition = {
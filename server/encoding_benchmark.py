@@ -0,0 +1,87 @@
+# To compare the size and encoding time of the e-paper display wire encodings
+# for each type of content, run:
+# $ pip install absl-py
+# $ python encoding_benchmark.py --variant=bwr
+
+from absl import app
+from absl import flags
+from logging import warning
+from statistics import median
+from time import perf_counter
+
+from arsenal import Arsenal
+from artwork import Artwork
+from city import City
+from config import get_user
+from config import load_config
+from epd import to_epd_bytes
+from epd import DEFAULT_DISPLAY_HEIGHT
+from epd import DEFAULT_DISPLAY_VARIANT
+from epd import DEFAULT_DISPLAY_WIDTH
+from epd import DISPLAY_VARIANTS
+from epd import WIRE_ENCODINGS
+from geocoder import Geocoder
+from google_calendar import GoogleCalendar
+from mbta import MBTA
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('width', DEFAULT_DISPLAY_WIDTH,
+                     'The width of the display in pixels.')
+flags.DEFINE_integer('height', DEFAULT_DISPLAY_HEIGHT,
+                     'The height of the display in pixels.')
+flags.DEFINE_enum('variant', DEFAULT_DISPLAY_VARIANT, DISPLAY_VARIANTS,
+                  'The display variant.')
+flags.DEFINE_integer('repeats', 10,
+                     'The number of times to time each encoding.')
+
+# The string format for each line of results.
+LINE_FORMAT = '%-16s %-8s %10s %8s %10s'
+
+
+def content_types():
+    """Creates an instance of each type of content."""
+
+    geocoder = Geocoder()
+    return [Artwork(), Arsenal(), GoogleCalendar(geocoder), City(geocoder),
+            MBTA()]
+
+
+def time_encoding(image, wire_encoding):
+    """Encodes the image and measures the median time it takes."""
+
+    times = []
+    for _ in range(FLAGS.repeats):
+        start = perf_counter()
+        data = to_epd_bytes(image, FLAGS.variant, wire_encoding=wire_encoding)
+        times.append(perf_counter() - start)
+
+    return data, median(times)
+
+
+def main(_):
+    load_config()
+    user = get_user()
+
+    print(LINE_FORMAT % ('Content', 'Encoding', 'Bytes', 'Ratio', 'Time (ms)'))
+    for content in content_types():
+        name = content.__class__.__name__
+        try:
+            image = content.image(user, FLAGS.width, FLAGS.height,
+                                  FLAGS.variant)
+        except Exception as e:
+            warning('Skipping %s content: %s' % (name, e))
+            continue
+
+        # Compare each encoding to the size of the raw bytes.
+        raw_size = None
+        for wire_encoding in WIRE_ENCODINGS:
+            data, seconds = time_encoding(image, wire_encoding)
+            if wire_encoding == 'raw':
+                raw_size = len(data)
+            print(LINE_FORMAT % (name, wire_encoding, len(data),
+                                 '%.1f%%' % (100 * len(data) / raw_size),
+                                 '%.2f' % (seconds * 1000)))
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -1,9 +1,32 @@
-from dithering import dither
+from dithering import closest_indices
+from dithering import dither_indices
+from dithering import encode_rle
+from dithering import pack
+from functools import lru_cache
+from io import BytesIO
+from numpy import arange
 from numpy import array
-from numpy import packbits
+from numpy import asarray
+from numpy import block
+from numpy import concatenate
+from numpy import diff
+from numpy import exp
+from numpy import float32
+from numpy import full
+from numpy import iinfo
+from numpy import int32
+from numpy import inf
+from numpy import minimum
+from numpy import random
+from numpy import roll
+from numpy import tile
 from numpy import uint8
+from numpy import unravel_index
+from numpy import where
+from numpy import zeros
+from numpy import zeros_like
+from os import cpu_count
 from PIL import Image
-from scipy.cluster.vq import vq
 
 # The default width of the display in pixels.
 DEFAULT_DISPLAY_WIDTH = 640
@@ -17,6 +40,79 @@ DISPLAY_VARIANTS = ['bwr', '7color']
 # The default display variant.
 DEFAULT_DISPLAY_VARIANT = 'bwr'
 
+# The number of bits per color channel used to index the palette lookup tables.
+PALETTE_LUT_BITS = 6
+
+# The palette lookup table value marking cells with more than one closest
+# palette color, which need a full search.
+PALETTE_LUT_AMBIGUOUS = 255
+
+# The supported dithering algorithms. Floyd-Steinberg and Atkinson diffuse the
+# quantization error, Bayer and blue noise are ordered dithering with a tiled
+# threshold map, and none maps each pixel to the closest palette color.
+DITHER_ALGORITHMS = ['floyd-steinberg', 'atkinson', 'bayer', 'blue-noise',
+                     'none']
+
+# The default dithering algorithm.
+DEFAULT_DITHER = 'floyd-steinberg'
+
+# The width and height of the Bayer threshold map. Must be a power of 2.
+BAYER_SIZE = 8
+
+# The width and height of the blue noise threshold map.
+BLUE_NOISE_SIZE = 64
+
+# The standard deviation in pixels of the Gaussian filter used to find clusters
+# and voids when generating the blue noise threshold map.
+BLUE_NOISE_SIGMA = 1.5
+
+# The fraction of pixels set in the initial blue noise pattern.
+BLUE_NOISE_DENSITY = 0.1
+
+# The random seed for the initial blue noise pattern, which keeps the threshold
+# map the same across server instances.
+BLUE_NOISE_SEED = 0
+
+# The number of threads used to dither large images. Rows are dithered in a
+# staggered wavefront, which produces the same output as a single thread.
+DITHER_THREADS = min(4, cpu_count() or 1)
+
+# The minimum number of pixels for an image to be dithered with multiple
+# threads. Smaller images aren't worth the thread overhead.
+DITHER_THREADS_MIN_PIXELS = 800 * 480
+
+# The number of rows below a band of dithered rows that receive its error.
+DITHER_CARRY_ROWS = 2
+
+# The formats for sending the image bytes to the display: either as they are or
+# compressed with the PackBits run-length encoding.
+WIRE_ENCODINGS = ['raw', 'rle']
+
+# The default format for sending the image bytes to the display.
+DEFAULT_WIRE_ENCODING = 'raw'
+
+# The formats of converted images: the wire encodings for the display and GIF
+# for previews.
+OUTPUT_FORMATS = WIRE_ENCODINGS + ['gif']
+
+# The number of unchanged rows that may separate two changed areas of a delta
+# image before they become separate rectangles. Each rectangle is a separate
+# partial refresh of the display.
+DELTA_MERGE_ROWS = 32
+
+# The maximum number of rectangles in a delta image. Any more changes are sent
+# as a single rectangle covering all of them.
+DELTA_MAX_RECTANGLES = 4
+
+# The horizontal alignment of rectangles in a delta image in pixels, which
+# partial windows of the display require.
+DELTA_ALIGNMENT = 8
+
+# The number of rows in each band of a streamed e-paper display image. A
+# multiple of 4 keeps each band a whole number of bytes at 2 or 4 bits per
+# pixel.
+EPD_BAND_HEIGHT = 32
+
 # Black, white, and red as an 8-bit RGB array.
 PALETTE_BWR = array([[0, 0, 0], [255, 255, 255], [255, 0, 0]], dtype=uint8)
 
@@ -36,31 +132,309 @@ ENCODING_7COLOR = array([[0, 0, 0, 0], [0, 0, 0, 1], [0, 0, 1, 0],
                          [0, 1, 1, 0]], dtype=uint8)
 
 
-def _dither(image, palette):
-    """Dithers the image using the Floyd-Steinberg algorithm."""
+@lru_cache(maxsize=None)
+def _palette_lut(variant):
+    """Builds a lookup table from RGB colors, quantized to PALETTE_LUT_BITS per
+    channel, to the index of the closest palette color."""
+
+    # Each cell of the table covers a cube of RGB colors. Find the closest
+    # palette color for each corner of each cube, keeping the first one on
+    # ties like the C extension does.
+    palette = epd_palette(variant).astype(int32)
+    num_cells = 1 << PALETTE_LUT_BITS
+    cell_size = 256 // num_cells
+    starts = arange(0, 256, cell_size, dtype=int32)
+    corners = array([starts, starts + cell_size - 1]).T.reshape(2 * num_cells)
+    min_distances = full((2 * num_cells,) * 3, iinfo(int32).max, dtype=int32)
+    closest = zeros_like(min_distances, dtype=uint8)
+    for index, (red, green, blue) in enumerate(palette):
+        distances = (((corners - red) ** 2)[:, None, None] +
+                     ((corners - green) ** 2)[None, :, None] +
+                     ((corners - blue) ** 2)[None, None, :])
+        closer = distances < min_distances
+        min_distances[closer] = distances[closer]
+        closest[closer] = index
+
+    # The colors closest to one palette color form a convex region, so if all
+    # corners of a cube agree, so does every color inside it. Otherwise, mark
+    # the cell for a full search.
+    closest = closest.reshape((num_cells, 2) * 3)
+    lut = closest[:, 0, :, 0, :, 0].copy()
+    ambiguous = (closest != lut[:, None, :, None, :, None]).any(axis=(1, 3, 5))
+    lut[ambiguous] = PALETTE_LUT_AMBIGUOUS
+
+    return lut
+
+
+def _rgb_pixels(image):
+    """Returns a read-only view of the image's RGB pixels."""
+
+    # Converting an image that is already RGB would copy it for nothing. The
+    # view shares the single buffer that the image exports its pixels to.
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    return asarray(image)
+
+
+def _dither(pixels, variant, algorithm):
+    """Dithers the RGB pixels using an error diffusion algorithm and returns
+    the palette index of each pixel."""
+
+    # Call the C extension to iterate over all image pixels efficiently. It
+    # records the chosen palette index of each pixel as it goes, so there is no
+    # need for a second nearest neighbor search. It only reads the pixels, so
+    # they don't need to be copied into a writable array first.
+    height, width, _ = pixels.shape
+    indices = dither_indices(pixels, epd_palette(variant),
+                             threads=_dither_threads(width, height),
+                             algorithm=algorithm, lut=_palette_lut(variant))
+
+    return indices.reshape(width * height)
+
+
+def _dither_bands(image, variant, algorithm):
+    """Dithers the image like _dither() but yields the palette indices in bands
+    of EPD_BAND_HEIGHT rows as soon as each band is done."""
+
+    # The carry holds the rows below each band with the error diffused into
+    # them so far, which makes the result identical to dithering all rows at
+    # once. It starts out as the first rows of the image.
+    pixels = _rgb_pixels(image)
+    carry = zeros((DITHER_CARRY_ROWS, image.width, 3), dtype=uint8)
+    first_rows = pixels[:DITHER_CARRY_ROWS]
+    carry[:len(first_rows)] = first_rows
+
+    for y in range(0, image.height, EPD_BAND_HEIGHT):
+        rows = min(EPD_BAND_HEIGHT, image.height - y)
+        yield dither_indices(pixels[y:y + rows + DITHER_CARRY_ROWS],
+                             epd_palette(variant),
+                             threads=_dither_threads(image.width,
+                                                     image.height),
+                             algorithm=algorithm, lut=_palette_lut(variant),
+                             rows=rows, carry=carry)
+
+
+def _dither_threads(width, height):
+    """Chooses the number of threads used to dither an image of the size."""
+
+    if width * height >= DITHER_THREADS_MIN_PIXELS:
+        return DITHER_THREADS
+    else:
+        return 1
+
+
+def _bayer_matrix(size):
+    """Generates a Bayer threshold map with values between 0 and 1."""
+
+    # Recursively build the index matrix from four shifted copies of itself.
+    matrix = zeros((1, 1))
+    while matrix.shape[0] < size:
+        matrix = block([[4 * matrix, 4 * matrix + 2],
+                        [4 * matrix + 3, 4 * matrix + 1]])
+
+    return (matrix + 0.5) / matrix.size
+
+
+@lru_cache(maxsize=None)
+def _blue_noise_matrix(size):
+    """Generates a blue noise threshold map with values between 0 and 1 using
+    the void-and-cluster method."""
+
+    # A Gaussian filter centered on (0, 0), wrapping around the edges so that
+    # the threshold map tiles seamlessly.
+    distances = minimum(arange(size), size - arange(size))
+    squared_distances = distances[:, None] ** 2 + distances[None, :] ** 2
+    kernel = exp(-squared_distances / (2 * BLUE_NOISE_SIGMA ** 2))
+
+    def filtered(pattern):
+        """Sums the filter centered on each set pixel of the pattern."""
+        energy = zeros((size, size))
+        for y, x in zip(*pattern.nonzero()):
+            energy += roll(kernel, (y, x), axis=(0, 1))
+        return energy
+
+    def tightest_cluster(pattern, energy):
+        """Finds the set pixel with the most set neighbors."""
+        return unravel_index(where(pattern, energy, -inf).argmax(),
+                             pattern.shape)
+
+    def largest_void(pattern, energy):
+        """Finds the unset pixel with the fewest set neighbors."""
+        return unravel_index(where(pattern, inf, energy).argmin(),
+                             pattern.shape)
+
+    def toggle(pattern, energy, xy, value):
+        """Sets or unsets a pixel of the pattern and updates the energy."""
+        pattern[xy] = value
+        energy += roll(kernel, xy, axis=(0, 1)) * (1 if value else -1)
+
+    # Start with random pixels and move the tightest cluster to the largest
+    # void until the pattern is evenly distributed.
+    generator = random.default_rng(BLUE_NOISE_SEED)
+    initial_pattern = generator.random((size, size)) < BLUE_NOISE_DENSITY
+    initial_energy = filtered(initial_pattern)
+    while True:
+        cluster = tightest_cluster(initial_pattern, initial_energy)
+        toggle(initial_pattern, initial_energy, cluster, False)
+        void = largest_void(initial_pattern, initial_energy)
+        toggle(initial_pattern, initial_energy, void, True)
+        if void == cluster:
+            break
+
+    # Rank the initial pixels by removing the tightest cluster one at a time.
+    ranks = zeros((size, size))
+    pattern = initial_pattern.copy()
+    energy = initial_energy.copy()
+    rank = pattern.sum()
+    while rank > 0:
+        rank -= 1
+        cluster = tightest_cluster(pattern, energy)
+        toggle(pattern, energy, cluster, False)
+        ranks[cluster] = rank
+
+    # Rank the remaining pixels by filling the largest void one at a time.
+    pattern = initial_pattern
+    energy = initial_energy
+    rank = pattern.sum()
+    while rank < size * size:
+        void = largest_void(pattern, energy)
+        toggle(pattern, energy, void, True)
+        ranks[void] = rank
+        rank += 1
+
+    return (ranks + 0.5) / ranks.size
+
+
+def _ordered_pixels(image, threshold_map):
+    """Prepares the image for ordered dithering by tiling the threshold map to
+    cover it. Offsetting the pixels by the thresholds and mapping them to the
+    closest palette colors completes the dithering."""
+
+    map_height, map_width = threshold_map.shape
+    thresholds = tile(threshold_map, (image.height // map_height + 1,
+                                      image.width // map_width + 1))
+    thresholds = thresholds[:image.height, :image.width].astype(float32)
+
+    return _rgb_pixels(image), thresholds - 0.5
+
+
+def _ordered_spread(variant):
+    """Returns the range of the offsets that ordered dithering adds to each
+    color channel for the palette."""
+
+    # Spanning the distance between the darkest and lightest palette colors
+    # keeps the tone of grays, which then dither to the share of light pixels
+    # matching their lightness.
+    palette = epd_palette(variant).astype(float32)
+    return palette.max(axis=0) - palette.min(axis=0)
+
+
+def _ordered_indices(ordered_pixels, variant):
+    """Maps each pixel, offset by its threshold scaled to the palette, to the
+    index of the closest palette color."""
+
+    # Offset each pixel, clipped to the range of colors.
+    rgb_pixels, thresholds = ordered_pixels
+    offsets = thresholds[:, :, None] * _ordered_spread(variant)
+    pixels = rgb_pixels + offsets
+    pixels = pixels.clip(0, 255, out=pixels).astype(uint8)
+
+    return _closest_indices(pixels, variant)
+
+
+def _closest_indices(pixels, variant):
+    """Maps each RGB pixel to the index of the closest palette color without
+    dithering."""
+
+    # Call the C extension to look up each pixel in the palette lookup table.
+    indices = closest_indices(pixels, epd_palette(variant),
+                              lut=_palette_lut(variant))
+
+    return indices.reshape(pixels.shape[0] * pixels.shape[1])
+
+
+def _quantized_pixels(image):
+    """Prepares an already quantized image for mapping to palette colors by
+    listing the colors of its pixel values."""
+
+    # List the colors of the image by their pixel value. Values beyond the end
+    # of a short palette are black, like when converting the image to RGB.
+    image_colors = zeros((256, 3), dtype=uint8)
+    if image.mode == 'P':
+        palette = array(image.getpalette(), dtype=uint8).reshape((-1, 3))
+        image_colors[:len(palette)] = palette
+    else:
+        image = image.convert('L')
+        image_colors[:] = arange(256, dtype=uint8)[:, None]
+
+    pixel_values = asarray(image).reshape(image.width * image.height)
+
+    return image_colors, pixel_values
 
-    # Call the C extension to iterate over all image pixels efficiently.
-    image = image.convert('RGB')
-    pixels = array(image)
-    dither(pixels, palette)
 
-    return Image.fromarray(pixels)
+def _quantized_indices(quantized_pixels, variant):
+    """Maps each pixel of an already quantized image to the index of the
+    closest palette color by mapping each of the image's colors only once."""
+
+    # Map the image colors to palette colors and then remap the pixel values.
+    image_colors, pixel_values = quantized_pixels
+    mapping = closest_indices(image_colors.reshape((1, 256, 3)),
+                              epd_palette(variant), lut=_palette_lut(variant))
+
+    return mapping.reshape(256).take(pixel_values)
+
+
+def _shared_pixels(image, dither=DEFAULT_DITHER):
+    """Does the part of mapping the image to palette colors that is the same
+    for all variants and returns the pixels for _color_indices()."""
+
+    if image.mode in ('1', 'L', 'P'):
+        return _quantized_pixels(image)
+    elif dither in ('none', 'floyd-steinberg', 'atkinson'):
+        return _rgb_pixels(image)
+    elif dither == 'bayer':
+        return _ordered_pixels(image, _bayer_matrix(BAYER_SIZE))
+    elif dither == 'blue-noise':
+        return _ordered_pixels(image, _blue_noise_matrix(BLUE_NOISE_SIZE))
+    else:
+        raise ValueError('Unsupported dithering algorithm: %s' % dither)
+
 
+def _color_indices(image, variant, dither=DEFAULT_DITHER, pixels=None):
+    """Maps each image pixel to the index of the closest palette color. The
+    pixels from _shared_pixels() may be passed in to reuse them between
+    variants."""
 
-def _color_indices(image, variant):
-    """Maps each image pixel to the index of the closest palette color."""
+    if pixels is None:
+        pixels = _shared_pixels(image, dither)
 
     # Apply dithering unless the image is already quantized.
-    palette = epd_palette(variant)
-    if image.mode not in ('1', 'L', 'P'):
-        image = _dither(image, palette)
+    if image.mode in ('1', 'L', 'P'):
+        return _quantized_indices(pixels, variant)
+    elif dither == 'none':
+        return _closest_indices(pixels, variant)
+    elif dither in ('bayer', 'blue-noise'):
+        return _ordered_indices(pixels, variant)
+    else:
+        return _dither(pixels, variant, dither)
+
 
-    # Map each pixel to the closest palette color.
-    image = image.convert('RGB')
-    image_data = array(image).reshape((image.width * image.height, 3))
-    indices, _ = vq(image_data, palette)
+def _color_index_bands(image, variant, dither=DEFAULT_DITHER):
+    """Maps each image pixel to the index of the closest palette color and
+    yields the indices in bands of EPD_BAND_HEIGHT rows."""
 
-    return indices
+    # Error diffusion takes long enough to be worth doing band by band. The
+    # other methods map the whole image at once.
+    if image.mode not in ('1', 'L', 'P') and dither in ('floyd-steinberg',
+                                                         'atkinson'):
+        yield from _dither_bands(image, variant, dither)
+        return
+
+    indices = _color_indices(image, variant, dither)
+    indices = indices.reshape((image.height, image.width))
+    for y in range(0, image.height, EPD_BAND_HEIGHT):
+        yield indices[y:y + EPD_BAND_HEIGHT]
 
 
 def epd_palette(variant):
@@ -85,22 +459,175 @@ def epd_encoding(variant):
         raise ValueError('Unsupported display variant: %s' % variant)
 
 
-def to_epd_image(image, variant):
-    """Converts the image's colors to the closest palette color."""
+def _palette_image(indices, variant, width, height):
+    """Creates an image with the palette colors of the indices."""
 
-    indices = _color_indices(image, variant)
-    palette = epd_palette(variant)
-    epd_image_data = palette[indices.reshape((image.height, image.width))]
-    return Image.fromarray(epd_image_data)
+    # Use the indices as they are with the palette, which saves converting
+    # them to RGB and back for formats like GIF.
+    epd_image = Image.fromarray(indices.reshape((height, width)), mode='P')
+    epd_image.putpalette(epd_palette(variant).tobytes())
+    return epd_image
 
 
-def to_epd_bytes(image, variant):
+def to_epd_image(image, variant, dither=DEFAULT_DITHER):
+    """Converts the image's colors to the closest palette color."""
+
+    indices = _color_indices(image, variant, dither)
+    return _palette_image(indices, variant, image.width, image.height)
+
+
+def indices_to_epd_image(indices, variant):
+    """Converts rows of palette color indices like those from to_epd_indices()
+    to an image like to_epd_image()."""
+
+    height, width = indices.shape
+    return _palette_image(indices, variant, width, height)
+
+
+def to_epd_outputs(image, outputs, dither=DEFAULT_DITHER, indices=None):
+    """Converts the image to each of the (variant, format) outputs in a single
+    pass and returns a dictionary of their bytes. Work that is the same for
+    all variants is only done once, and each variant is only mapped to its
+    palette once for all formats. Rows of palette color indices that are
+    already known may be passed in a dictionary by variant, which then also
+    receives the indices of the other variants."""
+
+    if indices is None:
+        indices = {}
+    pixels = None
+    packed = {}
+    results = {}
+    for variant, output_format in outputs:
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError('Unsupported output format: %s' % output_format)
+
+        if variant not in indices:
+            if pixels is None:
+                pixels = _shared_pixels(image, dither)
+            variant_indices = _color_indices(image, variant, dither, pixels)
+            indices[variant] = variant_indices.reshape((image.height,
+                                                        image.width))
+
+        if output_format == 'gif':
+            buffer = BytesIO()
+            indices_to_epd_image(indices[variant], variant).save(buffer,
+                                                                 format='gif')
+            results[(variant, output_format)] = buffer.getvalue()
+        else:
+            if variant not in packed:
+                packed[variant] = pack(indices[variant], epd_encoding(variant))
+            results[(variant, output_format)] = _wire_encode(packed[variant],
+                                                             output_format)
+
+    return results
+
+
+def _wire_encode(data, wire_encoding):
+    """Encodes the image bytes for sending them to the display."""
+
+    # Most images are long runs of white, which compress well.
+    if wire_encoding == 'rle':
+        return encode_rle(data)
+    elif wire_encoding == 'raw':
+        return data
+    else:
+        raise ValueError('Unsupported wire encoding: %s' % wire_encoding)
+
+
+def _changed_rectangles(previous_indices, indices):
+    """Finds rectangles of x, y, width, and height covering all pixels that
+    differ between two frames of palette indices."""
+
+    # Group the changed rows into bands, merging bands that are close.
+    changed = previous_indices != indices
+    rows = changed.any(axis=1).nonzero()[0]
+    if len(rows) == 0:
+        return []
+    breaks = (diff(rows) > DELTA_MERGE_ROWS).nonzero()[0]
+    tops = rows[concatenate(([0], breaks + 1))]
+    bottoms = rows[concatenate((breaks, [len(rows) - 1]))] + 1
+    if len(tops) > DELTA_MAX_RECTANGLES:
+        tops = tops[:1]
+        bottoms = bottoms[-1:]
+
+    # Narrow each band down to the aligned columns that changed.
+    width = indices.shape[1]
+    rectangles = []
+    for top, bottom in zip(tops, bottoms):
+        columns = changed[top:bottom].any(axis=0).nonzero()[0]
+        left = columns[0] // DELTA_ALIGNMENT * DELTA_ALIGNMENT
+        right = -(-(columns[-1] + 1) // DELTA_ALIGNMENT) * DELTA_ALIGNMENT
+        right = min(right, width)
+        rectangles.append((left, top, right - left, bottom - top))
+
+    return rectangles
+
+
+def to_epd_bytes(image, variant, dither=DEFAULT_DITHER,
+                 wire_encoding=DEFAULT_WIRE_ENCODING):
     """Converts the image to the closest 2-bit palette color bytes."""
 
-    indices = _color_indices(image, variant)
+    indices = _color_indices(image, variant, dither)
+    return indices_to_epd_bytes(indices, variant, wire_encoding)
+
+
+def indices_to_epd_bytes(indices, variant,
+                         wire_encoding=DEFAULT_WIRE_ENCODING):
+    """Converts palette color indices like those from to_epd_indices() to
+    bytes like to_epd_bytes()."""
+
     encoding = epd_encoding(variant)
-    epd_image_data = encoding[indices.reshape((image.height * image.width))]
-    return packbits(epd_image_data)
+
+    # Call the C extension to write the packed bits straight into the output.
+    return _wire_encode(pack(indices, encoding), wire_encoding)
+
+
+def to_epd_indices(image, variant, dither=DEFAULT_DITHER):
+    """Converts the image to rows of the closest palette color indices."""
+
+    indices = _color_indices(image, variant, dither)
+    return indices.reshape((image.height, image.width))
+
+
+def to_epd_delta(indices, previous_indices, variant,
+                 wire_encoding=DEFAULT_WIRE_ENCODING):
+    """Converts the changes between two frames of palette color indices to
+    bytes for partial refreshes of the display. Each changed rectangle is its
+    x, y, width, and height as big-endian 16-bit integers followed by its
+    pixels as palette color bytes. Without a previous frame of the same size,
+    the whole frame is one rectangle."""
+
+    height, width = indices.shape
+    if previous_indices is None or previous_indices.shape != indices.shape:
+        rectangles = [(0, 0, width, height)]
+    else:
+        rectangles = _changed_rectangles(previous_indices, indices)
+
+    encoding = epd_encoding(variant)
+    data = bytearray()
+    for x, y, rectangle_width, rectangle_height in rectangles:
+        header = array([x, y, rectangle_width, rectangle_height], dtype='>u2')
+        data += header.tobytes()
+        data += pack(indices[y:y + rectangle_height, x:x + rectangle_width],
+                     encoding)
+
+    return _wire_encode(bytes(data), wire_encoding)
+
+
+def to_epd_index_bands(image, variant, dither=DEFAULT_DITHER):
+    """Converts the image to rows of the closest palette color indices like
+    to_epd_indices() and yields them in bands of rows as they are ready."""
+
+    for indices in _color_index_bands(image, variant, dither):
+        yield indices.reshape((-1, image.width))
+
+
+def epd_bytes_length(width, height, variant):
+    """Returns the number of bytes of an image of the specified size converted
+    for the display."""
+
+    bits_per_pixel = epd_encoding(variant).shape[1]
+    return (width * height * bits_per_pixel + 7) // 8
 
 
 def adjust_xy(x, y, width, height):
@@ -111,3 +638,8 @@ def adjust_xy(x, y, width, height):
     y += (height - DEFAULT_DISPLAY_HEIGHT) // 2
 
     return x, y
+
+
+# Build the palette lookup tables on startup rather than on the first request.
+for variant in DISPLAY_VARIANTS:
+    _palette_lut(variant)
@@ -0,0 +1,29 @@
+from cachetools import TTLCache
+from threading import Lock
+
+# The maximum number of devices whose last frame is kept.
+MAX_DEVICES = 100
+
+# The time to live in seconds for the last frame of each device.
+FRAME_TTL_S = 24 * 60 * 60
+
+
+class Frames(object):
+    """The last frame sent to each device, for sending only what changed."""
+
+    def __init__(self):
+        self._frames = TTLCache(maxsize=MAX_DEVICES, ttl=FRAME_TTL_S)
+        self._lock = Lock()
+
+    def get(self, device):
+        """Returns the ETag and palette indices of the last frame sent to the
+        device, or None for both if there is none."""
+
+        with self._lock:
+            return self._frames.get(device, (None, None))
+
+    def put(self, device, etag, indices):
+        """Remembers the frame as the last one sent to the device."""
+
+        with self._lock:
+            self._frames[device] = (etag, indices)
@@ -13,6 +13,7 @@ from oauth2client.client import HttpAccessTokenRefreshError
 from PIL import Image
 from PIL.ImageDraw import Draw
 
+from asset_store import assets
 from database import DataError
 from database import GoogleCalendarStorage
 from graphics import draw_text
@@ -70,6 +71,11 @@ class GoogleCalendar(ImageContent):
     def __init__(self, geocoder):
         self._local_time = LocalTime(geocoder)
 
+    def asset_paths(self):
+        """Lists the paths of the assets drawn on the calendar."""
+
+        return [SQUIRCLE_FILE, DOT_FILE]
+
     def _days_range(self, start, end):
         """Returns a list of days of the month between two datetimes."""
 
@@ -184,10 +190,10 @@ class GoogleCalendar(ImageContent):
 
                 # Mark the current day with a squircle.
                 if day == time.day:
-                    squircle = Image.open(SQUIRCLE_FILE).convert(mode='RGBA')
+                    squircle = assets[SQUIRCLE_FILE]
                     squircle_xy = (x - squircle.width // 2,
                                    y - squircle.height // 2)
-                    draw.bitmap(squircle_xy, squircle, HIGHLIGHT_COLOR)
+                    squircle.draw_mask(draw, squircle_xy, HIGHLIGHT_COLOR)
                     number_color = TODAY_COLOR
                     event_color = TODAY_COLOR
                 else:
@@ -201,7 +207,7 @@ class GoogleCalendar(ImageContent):
 
                 # Draw a dot for each event.
                 num_events = min(MAX_EVENTS, event_counts[day])
-                dot = Image.open(DOT_FILE).convert(mode='RGBA')
+                dot = assets[DOT_FILE]
                 if num_events > 0:
                     events_width = (num_events * dot.width +
                                     (num_events - 1) * DOT_MARGIN)
@@ -210,7 +216,7 @@ class GoogleCalendar(ImageContent):
                                         DOT_MARGIN) - events_width // 2)
                         dot_xy = [x + event_offset,
                                   y + DOT_OFFSET - dot.width // 2]
-                        draw.bitmap(dot_xy, dot, event_color)
+                        dot.draw_mask(draw, dot_xy, event_color)
 
         # The calendar image is already quantized (no dithering).
         image = image.convert('P', dither=None, palette=Image.ADAPTIVE)
@@ -1,5 +1,15 @@
+from cachetools import cached
+from cachetools import LRUCache
+from functools import lru_cache
+from math import modf
+from numpy import array
+from numpy import maximum
+from numpy import uint8
+from numpy import zeros
+from PIL import Image
 from PIL import ImageFont
 from PIL.ImageDraw import Draw
+from threading import Lock
 
 # The FF SubVario Condensed Medium pixel font.
 SUBVARIO_CONDENSED_MEDIUM = {
@@ -25,26 +35,154 @@ SCREENSTAR_SMALL_REGULAR = {
 }
 
 
-def draw_text(text, font_spec, text_color, xy=None, anchor=None,
-              box_color=None, box_padding=0, border_color=None, border_width=0,
-              image=None, draw=None):
-    """Draws centered text on an image, optionally in a box."""
+# The font mode used to measure text when not drawing it, which is the mode for
+# drawing on RGB images.
+DEFAULT_FONT_MODE = 'L'
 
-    if not draw:
-        draw = Draw(image)
-    text_size = font_spec['size']
-    font = ImageFont.truetype(font_spec['file'], size=text_size)
+# The measured width of each character by font file, size, and font mode.
+_character_width_tables = {}
+
+# The characters with glyphs rendered up front for each font. Any others, and
+# any drawn at a fractional position, are rendered the first time they are
+# drawn.
+ATLAS_CHARACTERS = ''.join(chr(code) for code in range(32, 127))
+
+# The maximum number of glyphs kept in the cache besides the atlas, for the
+# other characters and for characters drawn at fractional positions.
+MAX_GLYPH_CACHE_SIZE = 2000
+
+
+@lru_cache(maxsize=None)
+def _load_font(file, size):
+    """Loads a font once and keeps it for all text using it."""
+
+    return ImageFont.truetype(file, size=size)
+
+
+def _font(font_spec):
+    """Returns the loaded font for the font spec."""
+
+    return _load_font(font_spec['file'], font_spec['size'])
+
+
+def _render_glyph(font, character, fontmode, start=(0, 0)):
+    """Renders the mask of the character and its offset from the text
+    position, starting at the fractional part of the position."""
+
+    mask, offset = font.getmask2(character, mode=fontmode, start=start)
+    width, height = mask.size
+    pixels = array(mask, dtype=uint8).reshape((height, width))
+
+    return pixels, offset
+
+
+@lru_cache(maxsize=None)
+def _glyph_atlas(file, size, fontmode):
+    """Renders the glyphs of the font once, so that drawing text doesn't need
+    to render them again."""
+
+    font = _load_font(file, size)
+    return {character: _render_glyph(font, character, fontmode)
+            for character in ATLAS_CHARACTERS}
+
+
+@cached(cache=LRUCache(maxsize=MAX_GLYPH_CACHE_SIZE), lock=Lock())
+def _cached_glyph(file, size, fontmode, character, start):
+    """Renders a glyph that isn't in the atlas, keeping the most recently
+    drawn ones."""
+
+    return _render_glyph(_load_font(file, size), character, fontmode, start)
+
+
+def _glyph(font_spec, character, fontmode, start):
+    """Returns the glyph mask and offset of the character from the atlas, or
+    from the cache if it isn't in the atlas."""
+
+    file = font_spec['file']
+    size = font_spec['size']
+    if start == (0, 0):
+        glyph = _glyph_atlas(file, size, fontmode).get(character)
+        if glyph is not None:
+            return glyph
+
+    return _cached_glyph(file, size, fontmode, character, start)
+
+
+def _draw_glyphs(text, character_widths, font_spec, text_color, x, y, draw):
+    """Draws the text by combining the glyph masks of its characters into one
+    mask for the whole text and drawing that at once."""
+
+    # Place each glyph like drawing each character on its own would: rendered
+    # from the fractional part of its position and drawn at the integer part.
+    placed_glyphs = []
+    for character, character_width in zip(text, character_widths):
+        start = (modf(x)[0], modf(y)[0])
+        pixels, (offset_x, offset_y) = _glyph(font_spec, character,
+                                              draw.fontmode, start)
+        if pixels.size:
+            placed_glyphs.append(
+                (int(x) + offset_x, int(y) + offset_y, pixels))
+        x += character_width
+    if not placed_glyphs:
+        return
+
+    # Combine the glyphs within their bounding box.
+    left = min(glyph_x for glyph_x, _, _ in placed_glyphs)
+    top = min(glyph_y for _, glyph_y, _ in placed_glyphs)
+    right = max(glyph_x + pixels.shape[1]
+                for glyph_x, _, pixels in placed_glyphs)
+    bottom = max(glyph_y + pixels.shape[0]
+                 for _, glyph_y, pixels in placed_glyphs)
+    text_mask = zeros((bottom - top, right - left), dtype=uint8)
+    for glyph_x, glyph_y, pixels in placed_glyphs:
+        height, width = pixels.shape
+        glyph_mask = text_mask[glyph_y - top:glyph_y - top + height,
+                               glyph_x - left:glyph_x - left + width]
+        maximum(glyph_mask, pixels, out=glyph_mask)
+
+    draw.bitmap((left, top), Image.fromarray(text_mask), fill=text_color)
+
+
+def _character_widths(text, font_spec, fontmode):
+    """Measures the width of each character, only asking the font about each
+    character the first time."""
+
+    font = _font(font_spec)
+    table = _character_width_tables.setdefault(
+        (font_spec['file'], font_spec['size'], fontmode), {})
+    width_overrides = font_spec['width_overrides']
 
-    # Measure the width of each character.
     character_widths = []
     for character in text:
         # Override the measured width, if specified.
-        width_overrides = font_spec['width_overrides']
-        if character in width_overrides.keys():
+        if character in width_overrides:
             character_width = width_overrides[character]
         else:
-            character_width = draw.textlength(character, font)
+            character_width = table.get(character)
+            if character_width is None:
+                character_width = font.getlength(character, fontmode)
+                table[character] = character_width
         character_widths.append(character_width)
+
+    return character_widths
+
+
+def measure_text(text, font_spec, fontmode=DEFAULT_FONT_MODE):
+    """Measures the width and height of the text without drawing it."""
+
+    text_width = sum(_character_widths(text, font_spec, fontmode))
+    return text_width, font_spec['height']
+
+
+def draw_text(text, font_spec, text_color, xy=None, anchor=None,
+              box_color=None, box_padding=0, border_color=None, border_width=0,
+              image=None, draw=None):
+    """Draws centered text on an image, optionally in a box."""
+
+    if not draw:
+        draw = Draw(image)
+    # Measure the width of each character.
+    character_widths = _character_widths(text, font_spec, draw.fontmode)
     text_width = sum(character_widths)
 
     # If any xy is specified, use it.
@@ -79,12 +217,16 @@ def draw_text(text, font_spec, text_color, xy=None, anchor=None,
     if box_color:
         draw.rectangle(box_xy, box_color)
 
-    # Draw the text character by character.
+    # Draw the text from the prerendered glyphs.
     y -= font_spec['y_offset']
-    for index in range(len(text)):
-        character = text[index]
-        draw.text((x, y), character, text_color, font)
-        x += character_widths[index]
+    _draw_glyphs(text, character_widths, font_spec, text_color, x, y, draw)
 
     # Return the bounding box for layout calculations.
     return border_xy
+
+
+# Render the glyphs of the fonts up front rather than on the request path,
+# for drawing on both RGB and palette images.
+for font_spec in [SUBVARIO_CONDENSED_MEDIUM, SCREENSTAR_SMALL_REGULAR]:
+    for fontmode in ['L', '1']:
+        _glyph_atlas(font_spec['file'], font_spec['size'], fontmode)
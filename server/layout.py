@@ -0,0 +1,123 @@
+from cachetools import cached
+from cachetools import LRUCache
+from cachetools.keys import hashkey
+
+from graphics import draw_text
+from graphics import measure_text
+
+# The text marking where text was shortened to fit.
+ELLIPSIS = '...'
+
+# The vertical space between lines of wrapped text in pixels.
+LINE_SPACING = 4
+
+# The maximum number of text layouts kept in the cache.
+MAX_CACHE_SIZE = 1000
+
+
+def _font_key(font_spec):
+    """Creates a hashable key for everything in the font spec that affects the
+    width of text."""
+
+    return (font_spec['file'], font_spec['size'],
+            tuple(sorted(font_spec['width_overrides'].items())))
+
+
+def _layout_key(text, font_spec, max_width, max_lines=None):
+    """Creates the cache key for a text layout, the same whether the maximum
+    number of lines is passed by position or by keyword."""
+
+    return hashkey(text, _font_key(font_spec), max_width, max_lines)
+
+
+def _text_width(text, font_spec):
+    """Measures the width of the text."""
+
+    text_width, _ = measure_text(text, font_spec)
+    return text_width
+
+
+@cached(cache=LRUCache(maxsize=MAX_CACHE_SIZE), key=_layout_key)
+def ellipsize(text, font_spec, max_width):
+    """Shortens the text to fit the width, ending it with an ellipsis if
+    anything had to be cut."""
+
+    if _text_width(text, font_spec) <= max_width:
+        return text
+
+    # Drop characters from the end until the rest fits with the ellipsis.
+    for end in range(len(text) - 1, 0, -1):
+        shortened = text[:end].rstrip() + ELLIPSIS
+        if _text_width(shortened, font_spec) <= max_width:
+            return shortened
+
+    return ELLIPSIS
+
+
+def _split_word(word, font_spec, max_width):
+    """Splits a word that is too wide for a line into parts that fit."""
+
+    parts = []
+    part = ''
+    for character in word:
+        if part and _text_width(part + character, font_spec) > max_width:
+            parts.append(part)
+            part = ''
+        part += character
+    parts.append(part)
+
+    return parts
+
+
+@cached(cache=LRUCache(maxsize=MAX_CACHE_SIZE), key=_layout_key)
+def wrap(text, font_spec, max_width, max_lines=None):
+    """Breaks the text into lines that fit the width at the spaces between
+    words. If there are more than the maximum number of lines, the last one
+    is ellipsized. Returns a tuple of the lines."""
+
+    # Fill each line with as many words as fit.
+    lines = []
+    line = ''
+    for word in text.split():
+        candidate = line + ' ' + word if line else word
+        if _text_width(candidate, font_spec) <= max_width:
+            line = candidate
+            continue
+        if line:
+            lines.append(line)
+        *word_lines, line = _split_word(word, font_spec, max_width)
+        lines.extend(word_lines)
+    if line:
+        lines.append(line)
+
+    # Fold any lines beyond the maximum into the last one.
+    if max_lines and len(lines) > max_lines:
+        last_line = ' '.join(lines[max_lines - 1:])
+        lines = lines[:max_lines - 1]
+        lines.append(ellipsize(last_line, font_spec, max_width))
+
+    return tuple(lines)
+
+
+def draw_text_box(text, font_spec, text_color, xy, max_width, max_lines=None,
+                  line_spacing=LINE_SPACING, image=None, draw=None):
+    """Draws text wrapped to the width, with the lines centered on a point."""
+
+    lines = wrap(text, font_spec, max_width, max_lines)
+    line_height = font_spec['height'] + line_spacing
+    x, y = xy
+    y -= (len(lines) - 1) * line_height // 2
+
+    # Draw each line and return the bounding box of all of them.
+    box = None
+    for line in lines:
+        line_box = draw_text(line, font_spec, text_color, xy=(x, y),
+                             image=image, draw=draw)
+        if box:
+            box = [min(box[0], line_box[0]), min(box[1], line_box[1]),
+                   max(box[2], line_box[2]), max(box[3], line_box[3])]
+        else:
+            box = line_box
+        y += line_height
+
+    return box
@@ -1,3 +1,4 @@
+from functools import partial
 from functools import wraps
 from flask import Flask
 from flask import redirect
@@ -10,20 +11,30 @@ from oauth2client.client import OAuth2WebServerFlow
 from time import time
 
 from arsenal import Arsenal
+from asset_store import assets
 from artwork import Artwork
 from city import City
 from config import get_user, get_google_calendar_secrets, load_config
 from content import ContentError
 from database import GoogleCalendarStorage
 from epd import DEFAULT_DISPLAY_VARIANT
+from frames import Frames
 from geocoder import Geocoder
 from google_calendar import GoogleCalendar
 from mbta import MBTA
+from prerender import Prerenderer
 from response import content_response
+from response import device_metadata
 from response import display_metadata
+from response import dither_metadata
+from response import epd_delta_response
 from response import epd_response
+from response import forbidden_response
 from response import gif_response
+from response import render_cache
+from response import COMPUTER_FILE
 from response import text_response
+from response import wire_encoding_metadata
 from schedule import Schedule
 
 # Load configuration on startup
@@ -35,6 +46,10 @@ GOOGLE_CALENDAR_SCOPE = 'https://www.googleapis.com/auth/calendar.readonly'
 # The time in milliseconds to return in an unauthorized next request.
 NEXT_RETRY_DELAY_MILLIS = 5 * 60 * 1000  # 5 minutes
 
+# The addresses of clients allowed to read the render cache statistics, which
+# are only meant for the server's own operator.
+STATS_ADDRESSES = ['127.0.0.1', '::1']
+
 # A geocoder instance with a shared cache.
 geocoder = Geocoder()
 
@@ -46,6 +61,15 @@ city = City(geocoder)
 mbta = MBTA()
 schedule = Schedule(geocoder)
 
+# The last frame sent to each device for partial refreshes.
+frames = Frames()
+
+# A background scheduler rendering images ahead of the next wake.
+prerenderer = Prerenderer(schedule)
+
+# Decode the image assets up front rather than on the first requests.
+assets.warm_up(city.asset_paths() + calendar.asset_paths() + [COMPUTER_FILE])
+
 # The Flask app handling requests.
 app = Flask(__name__)
 
@@ -79,7 +103,9 @@ def next_retry_response():
 def artwork_gif(key=None, user=None):
     """Responds with a GIF version of the artwork image."""
     width, height, variant = display_metadata(request)
-    return content_response(artwork, gif_response, user, width, height, variant)
+    dither = dither_metadata(request)
+    return content_response(artwork, gif_response, user, width, height, variant,
+                            dither)
 
 
 @app.route('/city')
@@ -87,7 +113,9 @@ def artwork_gif(key=None, user=None):
 def city_gif(key=None, user=None):
     """Responds with a GIF version of the city image."""
     width, height, variant = display_metadata(request)
-    return content_response(city, gif_response, user, width, height, variant)
+    dither = dither_metadata(request)
+    return content_response(city, gif_response, user, width, height, variant,
+                            dither)
 
 
 @app.route('/calendar')
@@ -95,7 +123,9 @@ def city_gif(key=None, user=None):
 def calendar_gif(key=None, user=None):
     """Responds with a GIF version of the calendar image."""
     width, height, variant = display_metadata(request)
-    return content_response(calendar, gif_response, user, width, height, variant)
+    dither = dither_metadata(request)
+    return content_response(calendar, gif_response, user, width, height, variant,
+                            dither)
 
 
 @app.route('/mbta')
@@ -103,7 +133,9 @@ def calendar_gif(key=None, user=None):
 def mbta_gif(key=None, user=None):
     """Responds with a GIF version of the MBTA image."""
     width, height, variant = display_metadata(request)
-    return content_response(mbta, gif_response, user, width, height, variant)
+    dither = dither_metadata(request)
+    return content_response(mbta, gif_response, user, width, height, variant,
+                            dither)
 
 
 @app.route('/arsenal')
@@ -111,7 +143,9 @@ def mbta_gif(key=None, user=None):
 def arsenal_gif(key=None, user=None):
     """Responds with a GIF version of the Arsenal image."""
     width, height, variant = display_metadata(request)
-    return content_response(arsenal, gif_response, user, width, height, variant)
+    dither = dither_metadata(request)
+    return content_response(arsenal, gif_response, user, width, height, variant,
+                            dither)
 
 
 @app.route('/gif')
@@ -119,7 +153,9 @@ def arsenal_gif(key=None, user=None):
 def gif(key=None, user=None):
     """Responds with a GIF version of the scheduled image."""
     width, height, variant = display_metadata(request)
-    return content_response(schedule, gif_response, user, width, height, variant)
+    dither = dither_metadata(request)
+    return content_response(schedule, gif_response, user, width, height, variant,
+                            dither)
 
 
 @app.route('/epd')
@@ -127,7 +163,28 @@ def gif(key=None, user=None):
 def epd(key=None, user=None):
     """Responds with an e-paper display version of the scheduled image."""
     width, height, variant = display_metadata(request)
-    return content_response(schedule, epd_response, user, width, height, variant)
+    dither = dither_metadata(request)
+    wire_encoding = wire_encoding_metadata(request)
+    prerenderer.add_display(width, height, variant, dither, wire_encoding)
+    image_response = partial(epd_response, wire_encoding=wire_encoding)
+    return content_response(schedule, image_response, user, width, height,
+                            variant, dither)
+
+
+@app.route('/epd/delta')
+@user_auth(image_response=epd_delta_response)
+def epd_delta(key=None, user=None):
+    """Responds with the regions of the e-paper display version of the
+    scheduled image that changed since the last one sent to the device."""
+    width, height, variant = display_metadata(request)
+    dither = dither_metadata(request)
+    wire_encoding = wire_encoding_metadata(request)
+    device = device_metadata(request)
+    prerenderer.add_display(width, height, variant, dither, wire_encoding)
+    image_response = partial(epd_delta_response, frames, device,
+                             wire_encoding=wire_encoding)
+    return content_response(schedule, image_response, user, width, height,
+                            variant, dither)
 
 
 @app.route('/next')
@@ -136,12 +193,22 @@ def next(key=None, user=None):
     """Responds with the milliseconds until the next image."""
     try:
         milliseconds = schedule.delay(user)
+        prerenderer.schedule(user, milliseconds)
         return text_response(str(milliseconds))
     except ContentError as e:
         exception('Failed to create next content: %s' % e)
         return next_retry_response()
 
 
+@app.route('/stats')
+def stats():
+    """Responds with the render cache hit and miss statistics to requests from
+    the server's own machine."""
+    if request.remote_addr not in STATS_ADDRESSES:
+        return forbidden_response()
+    return render_cache.stats()
+
+
 @app.route('/')
 def index():
     """Simple status page."""
@@ -13,6 +13,7 @@ from content import ImageContent
 from database import DataError
 from graphics import draw_text
 from graphics import SUBVARIO_CONDENSED_MEDIUM
+from layout import draw_text_box
 
 # MBTA API v3 endpoint
 MBTA_API_URL = 'https://api-v3.mbta.com'
@@ -28,6 +29,8 @@ TITLE_Y = 60
 STATUS_Y = 120
 PREDICTION_START_Y = 180
 PREDICTION_SPACING = 50
+TEXT_MARGIN = 20
+ALERT_MAX_LINES = 2
 
 
 class MBTA(ImageContent):
@@ -146,10 +149,11 @@ class MBTA(ImageContent):
 
         # Draw status
         if alerts:
-            # Show first alert
-            alert_text = alerts[0][:50]  # Truncate if too long
-            draw_text(alert_text, SUBVARIO_CONDENSED_MEDIUM, ALERT_COLOR,
-                      xy=(width // 2, STATUS_Y), image=image, draw=draw)
+            # Show first alert, wrapped and shortened to fit
+            draw_text_box(alerts[0], SUBVARIO_CONDENSED_MEDIUM, ALERT_COLOR,
+                          xy=(width // 2, STATUS_Y),
+                          max_width=width - 2 * TEXT_MARGIN,
+                          max_lines=ALERT_MAX_LINES, image=image, draw=draw)
         else:
             draw_text('Normal Service', SUBVARIO_CONDENSED_MEDIUM, TEXT_COLOR,
                       xy=(width // 2, STATUS_Y), image=image, draw=draw)
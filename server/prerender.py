@@ -0,0 +1,86 @@
+from cachetools import TTLCache
+from logging import exception
+from logging import info
+from threading import Lock
+from threading import Timer
+
+from response import image_etag
+from response import prerender_epd
+from response import render_cache
+from schedule import DELAY_BUFFER_S
+
+# The time in seconds before a predicted wake to start rendering the image.
+PRERENDER_LEAD_S = 2 * 60  # 2 minutes
+
+# The time in seconds to keep a prerendered image unless a request takes it
+# first: until the predicted wake, plus as much as the schedule allows the
+# actual wake to differ from it.
+PRERENDER_TTL_S = PRERENDER_LEAD_S + DELAY_BUFFER_S
+
+# The maximum number of display configurations to prerender images for.
+MAX_DISPLAYS = 8
+
+# The time to live in seconds for display configurations that stop requesting
+# images.
+DISPLAY_TTL_S = 7 * 24 * 60 * 60  # 1 week
+
+
+class Prerenderer(object):
+    """A background scheduler rendering the next scheduled image shortly
+    before the client is predicted to wake, so that its request is served from
+    the render cache without waiting for upstream APIs or dithering."""
+
+    def __init__(self, schedule):
+        self._schedule = schedule
+        self._displays = TTLCache(maxsize=MAX_DISPLAYS, ttl=DISPLAY_TTL_S)
+        self._timer = None
+        self._lock = Lock()
+
+    def add_display(self, width, height, variant, dither, wire_encoding):
+        """Remembers a display configuration to prerender images for."""
+
+        display = (width, height, variant, dither, wire_encoding)
+        with self._lock:
+            self._displays[display] = True
+
+    def schedule(self, user, delay_ms):
+        """Schedules prerendering ahead of the wake after the delay, replacing
+        any previously scheduled prerendering."""
+
+        delay_s = max(delay_ms / 1000 - PRERENDER_LEAD_S, 0)
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+            self._timer = Timer(delay_s, self._prerender, args=[user])
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _prerender(self, user):
+        """Renders and encodes the scheduled image for each display."""
+
+        with self._lock:
+            displays = list(self._displays)
+
+        # Displays of different variants often show the same image, which is
+        # then converted for all of them at once.
+        batches = {}
+        for width, height, variant, dither, wire_encoding in displays:
+            info('Prerendering %dx%d %s image' % (width, height, variant))
+            try:
+                image = render_cache.prerender(self._schedule, user, width,
+                                               height, variant,
+                                               PRERENDER_TTL_S)
+            except Exception as e:
+                # Log any failure and go on with the other displays, rather
+                # than ending the timer thread without a trace.
+                exception('Failed to prerender content: %s' % e)
+                continue
+            _, outputs = batches.setdefault((image_etag(image), dither),
+                                            (image, []))
+            outputs.append((variant, wire_encoding))
+
+        for (_, dither), (image, outputs) in batches.items():
+            try:
+                prerender_epd(image, outputs, dither)
+            except Exception as e:
+                exception('Failed to convert prerendered image: %s' % e)
@@ -0,0 +1,209 @@
+from cachetools import TLRUCache
+from cachetools import TTLCache
+from numpy import concatenate
+from threading import Lock
+
+# The maximum number of composed content images kept in the cache.
+MAX_IMAGE_CACHE_SIZE = 8
+
+# The time to live in seconds for cached content images. Content like the time
+# and the weather changes, so they are only reused for a short while.
+IMAGE_CACHE_TTL_S = 60  # 1 minute
+
+# The maximum total size in bytes of the encoded image payloads kept in the
+# cache.
+MAX_PAYLOAD_CACHE_BYTES = 16 * 1024 * 1024  # 16 MB
+
+# The maximum total size in bytes of the palette color indices kept in the
+# cache.
+MAX_INDICES_CACHE_BYTES = 8 * 1024 * 1024  # 8 MB
+
+# The time to live in seconds for cached payloads and indices. They are keyed
+# by the image pixels, so they don't go stale and only expire to free unused
+# memory.
+PAYLOAD_CACHE_TTL_S = 60 * 60  # 1 hour
+
+
+class RenderCache(object):
+    """A cache of composed content images, of the palette color indices
+    dithered from them, and of the payloads encoded from them, with least
+    recently used and time to live eviction."""
+
+    def __init__(self):
+        self._tiers = {
+            'images': TLRUCache(maxsize=MAX_IMAGE_CACHE_SIZE,
+                                ttu=self._image_expiry),
+            'indices': TTLCache(maxsize=MAX_INDICES_CACHE_BYTES,
+                                ttl=PAYLOAD_CACHE_TTL_S,
+                                getsizeof=lambda indices: indices.nbytes),
+            'payloads': TTLCache(maxsize=MAX_PAYLOAD_CACHE_BYTES,
+                                 ttl=PAYLOAD_CACHE_TTL_S, getsizeof=len)
+        }
+        self._hits = {tier: 0 for tier in self._tiers}
+        self._misses = {tier: 0 for tier in self._tiers}
+        self._lock = Lock()
+
+    @staticmethod
+    def _image_expiry(key, value, now):
+        """Finds the expiry time of an image from its own time to live."""
+
+        _, ttl_s = value
+        return now + ttl_s
+
+    def _get(self, tier, key):
+        """Looks up the key in the tier and counts the hit or miss."""
+
+        with self._lock:
+            value = self._tiers[tier].get(key)
+            if value is None:
+                self._misses[tier] += 1
+            else:
+                self._hits[tier] += 1
+            return value
+
+    def _put(self, tier, key, value):
+        """Stores the value for the key in the tier, unless it alone is larger
+        than the tier."""
+
+        with self._lock:
+            cache = self._tiers[tier]
+            if cache.getsizeof(value) > cache.maxsize:
+                return
+            cache[key] = value
+
+    def image(self, content, user, width, height, variant):
+        """Returns the composed content image for the inputs, generating it if
+        it isn't cached."""
+
+        key = self._image_key(content, user, width, height, variant)
+        value = self._get('images', key)
+        if value is None:
+            image = content.image(user, width, height, variant)
+            self._put('images', key, (image, IMAGE_CACHE_TTL_S))
+        else:
+            image, ttl_s = value
+            # A prerendered image is kept until the first request for it.
+            # From then on, it expires like any other, so later requests
+            # don't get stale content.
+            if ttl_s != IMAGE_CACHE_TTL_S:
+                self._put('images', key, (image, IMAGE_CACHE_TTL_S))
+
+        return image
+
+    def prerender(self, content, user, width, height, variant, ttl_s):
+        """Generates the content image ahead of requests for it and caches it,
+        replacing an older one, for the specified time to live or until the
+        first request for it."""
+
+        key = self._image_key(content, user, width, height, variant)
+        image = content.image(user, width, height, variant)
+        self._put('images', key, (image, ttl_s))
+
+        return image
+
+    @staticmethod
+    def _image_key(content, user, width, height, variant):
+        """Creates the cache key for a content image."""
+
+        return content.__class__.__name__, repr(user), width, height, variant
+
+    def indices(self, key, convert):
+        """Returns the palette color indices for the key, calling the convert
+        function to create them if they aren't cached."""
+
+        indices = self.cached_indices(key)
+        if indices is None:
+            indices = convert()
+            self.put_indices(key, indices)
+
+        return indices
+
+    def cached_indices(self, key):
+        """Returns the palette color indices for the key, or None if they
+        aren't cached."""
+
+        return self._get('indices', key)
+
+    def index_bands(self, key, convert_bands):
+        """Returns the palette color indices for the key in bands of rows. If
+        they aren't cached, the bands come from the convert function as they
+        are created and the indices are cached once they are complete."""
+
+        indices = self._get('indices', key)
+        if indices is None:
+            return self._cached_bands(key, convert_bands())
+
+        return [indices]
+
+    def _cached_bands(self, key, bands):
+        """Passes the bands through and caches their indices once complete."""
+
+        complete_bands = []
+        for band in bands:
+            complete_bands.append(band)
+            yield band
+
+        self.put_indices(key, concatenate(complete_bands))
+
+    def put_indices(self, key, indices):
+        """Stores the palette color indices for the key, read-only since all
+        responses for the image share them."""
+
+        indices.flags.writeable = False
+        self._put('indices', key, indices)
+
+    def payload(self, key, encode):
+        """Returns the encoded payload for the key, calling the encode function
+        to create it if it isn't cached."""
+
+        data = self._get('payloads', key)
+        if data is None:
+            data = encode()
+            self._put('payloads', key, data)
+
+        return data
+
+    def put_payload(self, key, data):
+        """Stores the encoded payload for the key."""
+
+        self._put('payloads', key, data)
+
+    def payload_chunks(self, key, encode_chunks):
+        """Returns the encoded payload for the key as chunks. If it isn't
+        cached, the chunks come from the encode function as they are created
+        and the payload is cached once they are complete."""
+
+        data = self._get('payloads', key)
+        if data is None:
+            return self._cached_chunks(key, encode_chunks())
+
+        return [data]
+
+    def _cached_chunks(self, key, chunks):
+        """Passes the chunks through and caches them once complete."""
+
+        data = bytearray()
+        for chunk in chunks:
+            data += chunk
+            yield chunk
+
+        self._put('payloads', key, bytes(data))
+
+    def clear(self):
+        """Removes all images, indices, and payloads from the cache."""
+
+        with self._lock:
+            for cache in self._tiers.values():
+                cache.clear()
+
+    def stats(self):
+        """Returns the hit and miss counts and the size of each tier, in
+        entries for the images and in bytes for the indices and payloads."""
+
+        with self._lock:
+            return {tier: {'hits': self._hits[tier],
+                           'misses': self._misses[tier],
+                           'entries': len(cache),
+                           'size': cache.currsize,
+                           'max_size': cache.maxsize}
+                    for tier, cache in self._tiers.items()}
@@ -1,21 +1,34 @@
+from flask import request
 from flask import Response
 from flask import send_file
 from flask import url_for
+from hashlib import blake2b
 from io import BytesIO
 from logging import exception
 from logging import warning
 from PIL import Image
+from time import time
 
+from asset_store import assets
 from content import ContentError
 from epd import adjust_xy
-from epd import to_epd_bytes
-from epd import to_epd_image
+from epd import epd_bytes_length
+from epd import indices_to_epd_bytes
+from epd import to_epd_delta
+from epd import to_epd_index_bands
+from epd import to_epd_indices
+from epd import to_epd_outputs
 from epd import DEFAULT_DISPLAY_HEIGHT
+from epd import DEFAULT_DITHER
 from epd import DEFAULT_DISPLAY_WIDTH
 from epd import DEFAULT_DISPLAY_VARIANT
+from epd import DEFAULT_WIRE_ENCODING
 from epd import DISPLAY_VARIANTS
+from epd import DITHER_ALGORITHMS
+from epd import WIRE_ENCODINGS
 from graphics import draw_text
 from graphics import SUBVARIO_CONDENSED_MEDIUM
+from render_cache import RenderCache
 
 # The color of the new user image background.
 BACKGROUND_COLOR = (255, 0, 0)
@@ -32,25 +45,163 @@ COMPUTER_XY = (296, 145)
 # The position of the link text in the settings image.
 LINK_TEXT_XY = (0, 228)
 
+# The cache of composed content images, their palette color indices, and
+# encoded payloads for all responses.
+render_cache = RenderCache()
 
-def gif_response(image, variant):
+
+def image_etag(image, *parameters):
+    """Computes a strong ETag from the image pixels and the parameters used to
+    convert them."""
+
+    # The conversion only depends on these, so there is no need to convert the
+    # image to find out whether the client already has it.
+    digest = blake2b(digest_size=16)
+    digest.update(repr((image.mode, image.size, parameters)).encode())
+    if image.mode == 'P':
+        digest.update(bytes(image.getpalette()))
+    digest.update(image.tobytes())
+
+    return digest.hexdigest()
+
+
+def epd_indices(image, variant, dither=DEFAULT_DITHER):
+    """Returns the palette color indices of the image for the display,
+    converting them only if they aren't cached."""
+
+    etag = image_etag(image, 'indices', variant, dither)
+    return render_cache.indices(
+        etag, lambda: to_epd_indices(image, variant, dither))
+
+
+def epd_index_bands(image, variant, dither=DEFAULT_DITHER):
+    """Returns the palette color indices of the image for the display like
+    epd_indices(), but in bands of rows as they are converted if they aren't
+    cached."""
+
+    etag = image_etag(image, 'indices', variant, dither)
+    return render_cache.index_bands(
+        etag, lambda: to_epd_index_bands(image, variant, dither))
+
+
+def gif_response(image, variant, dither=DEFAULT_DITHER):
     """Creates a Flask GIF response from the specified image."""
 
-    buffer = BytesIO()
-    image = to_epd_image(image, variant)
-    image.save(buffer, format='gif')
-    buffer.seek(0)
+    etag = image_etag(image, 'gif', variant, dither)
+    if request.if_none_match.contains(etag):
+        return not_modified_response(etag)
+
+    # The indices are usually cached from /epd requests for the same image.
+    def encode():
+        indices = {variant: epd_indices(image, variant, dither)}
+        outputs = to_epd_outputs(image, [(variant, 'gif')], dither, indices)
+        return outputs[(variant, 'gif')]
+
+    buffer = BytesIO(render_cache.payload(etag, encode))
 
-    return send_file(buffer, mimetype='image/gif', max_age=0)
+    return send_file(buffer, mimetype='image/gif', max_age=0, etag=etag)
 
 
-def epd_response(image, variant):
+def epd_response(image, variant, dither=DEFAULT_DITHER,
+                 wire_encoding=DEFAULT_WIRE_ENCODING):
     """Creates a Flask e-paper display response from the specified image."""
 
-    data = to_epd_bytes(image, variant)
-    buffer = BytesIO(data)
+    etag = image_etag(image, 'epd', variant, dither, wire_encoding)
+    if request.if_none_match.contains(etag):
+        return not_modified_response(etag)
+
+    if wire_encoding == 'raw':
+        # Stream the image in bands of rows as they are converted, so the
+        # client can start receiving it before the whole image is done. The
+        # length is known up front, which lets the client tell when it has
+        # everything.
+        def encode_bands():
+            for indices in epd_index_bands(image, variant, dither):
+                yield indices_to_epd_bytes(indices, variant, wire_encoding)
+
+        data = render_cache.payload_chunks(etag, encode_bands)
+        length = epd_bytes_length(image.width, image.height, variant)
+    else:
+        # The length of compressed data is only known once it's complete, and
+        # the client needs it up front, so it isn't streamed. The indices are
+        # usually prerendered, which leaves only packing and compressing them.
+        data = render_cache.payload(etag, lambda: indices_to_epd_bytes(
+            epd_indices(image, variant, dither), variant, wire_encoding))
+        length = len(data)
+
+    response = Response(data, mimetype='application/octet-stream')
+    response.content_length = length
+    response.set_etag(etag)
+
+    return no_cache(response)
+
+
+def epd_delta_response(frames, device, image, variant, dither=DEFAULT_DITHER,
+                       wire_encoding=DEFAULT_WIRE_ENCODING):
+    """Creates a Flask e-paper display response with only the regions of the
+    specified image that changed since the last one sent to the device."""
+
+    etag = image_etag(image, 'epd-delta', variant, dither, wire_encoding)
+    if request.if_none_match.contains(etag):
+        return not_modified_response(etag)
+
+    # Only send the changes if the client still shows the last frame, which
+    # it confirms by sending its ETag. Otherwise, send the whole frame.
+    last_etag, last_indices = frames.get(device)
+    if not last_etag or not request.if_none_match.contains(last_etag):
+        last_indices = None
+
+    indices = epd_indices(image, variant, dither)
+    data = to_epd_delta(indices, last_indices, variant, wire_encoding)
+    frames.put(device, etag, indices)
+
+    response = Response(data, mimetype='application/octet-stream')
+    response.content_length = len(data)
+    response.set_etag(etag)
+
+    return no_cache(response)
+
 
-    return send_file(buffer, mimetype='application/octet-stream', max_age=0)
+def prerender_epd(image, outputs, dither=DEFAULT_DITHER):
+    """Converts a prerendered image to the (variant, wire encoding) outputs of
+    e-paper displays at once, ahead of their requests, so that they are served
+    from the cache."""
+
+    # Reuse the indices of any variant the image was already converted to.
+    index_etags = {variant: image_etag(image, 'indices', variant, dither)
+                   for variant, _ in outputs}
+    indices = {}
+    for variant, etag in index_etags.items():
+        variant_indices = render_cache.cached_indices(etag)
+        if variant_indices is not None:
+            indices[variant] = variant_indices
+
+    results = to_epd_outputs(image, outputs, dither, indices)
+    for variant, etag in index_etags.items():
+        render_cache.put_indices(etag, indices[variant])
+    for (variant, wire_encoding), data in results.items():
+        etag = image_etag(image, 'epd', variant, dither, wire_encoding)
+        render_cache.put_payload(etag, data)
+
+
+def not_modified_response(etag):
+    """Creates a response telling the client that its copy of the image with
+    the specified ETag is current."""
+
+    response = Response(status=304)
+    response.set_etag(etag)
+
+    return no_cache(response)
+
+
+def no_cache(response):
+    """Makes clients check with the server before reusing the response."""
+
+    response.cache_control.no_cache = True
+    response.cache_control.max_age = 0
+    response.expires = int(time())
+
+    return response
 
 
 def text_response(text):
@@ -71,7 +222,8 @@ def settings_url(key):
     return url_for('hello_get', key=key, _external=True)
 
 
-def settings_response(key, image_func, width, height, variant):
+def settings_response(key, image_func, width, height, variant,
+                      dither=DEFAULT_DITHER):
     """Creates an image response to start the new user flow."""
 
     # Draw the image with the link text and a computer.
@@ -82,25 +234,25 @@ def settings_response(key, image_func, width, height, variant):
               xy=adjust_xy(*LINK_TEXT_XY, width, height),
               anchor='center_x',
               image=image)
-    computer = Image.open(COMPUTER_FILE).convert(mode='RGBA')
-    image.paste(computer, box=adjust_xy(*COMPUTER_XY, width, height),
-                mask=computer)
+    assets[COMPUTER_FILE].paste(image,
+                                adjust_xy(*COMPUTER_XY, width, height))
 
-    return image_func(image, variant)
+    return image_func(image, variant, dither)
 
 
-def content_response(content, image_response, user, width, height, variant):
+def content_response(content, image_response, user, width, height, variant,
+                     dither=DEFAULT_DITHER):
     """Creates an image response and handles the error case flow."""
 
     try:
-        image = content.image(user, width, height, variant)
-        return image_response(image, variant)
+        image = render_cache.image(content, user, width, height, variant)
+        return image_response(image, variant, dither)
     except ContentError as e:
         exception('Failed to create %s content: %s' % (
             content.__class__.__name__, e))
         # For single-user setup, use 'default' as the key
         return settings_response('default', image_response, width, height,
-                                 variant)
+                                 variant, dither)
 
 
 def display_metadata(request):
@@ -119,3 +271,38 @@ def display_metadata(request):
     except ValueError:
         warning('Malformed display size: %sx%s' % (width, height))
         return DEFAULT_DISPLAY_WIDTH, DEFAULT_DISPLAY_HEIGHT, variant
+
+
+def device_metadata(request):
+    """Extracts a key identifying the device from the request."""
+
+    # Devices authenticate with their key as the password and an empty user.
+    authorization = request.authorization
+    if authorization and authorization.password:
+        return authorization.password
+
+    return request.remote_addr
+
+
+def dither_metadata(request):
+    """Extracts the dithering algorithm from the request or uses the default."""
+
+    dither = request.args.get('dither', default=DEFAULT_DITHER)
+
+    if dither not in DITHER_ALGORITHMS:
+        warning('Invalid dithering algorithm: %s' % dither)
+        dither = DEFAULT_DITHER
+
+    return dither
+
+
+def wire_encoding_metadata(request):
+    """Extracts the wire encoding from the request or uses the default."""
+
+    wire_encoding = request.args.get('encoding', default=DEFAULT_WIRE_ENCODING)
+
+    if wire_encoding not in WIRE_ENCODINGS:
+        warning('Invalid wire encoding: %s' % wire_encoding)
+        wire_encoding = DEFAULT_WIRE_ENCODING
+
+    return wire_encoding
@@ -0,0 +1,97 @@
+from dithering import dither_indices
+from io import BytesIO
+from numpy import asarray
+from numpy import random
+from numpy import uint8
+from PIL import Image
+from unittest import main
+from unittest import TestCase
+
+from epd import _palette_lut
+from epd import epd_palette
+from epd import to_epd_bytes
+from epd import to_epd_image
+from epd import to_epd_indices
+from epd import to_epd_outputs
+from epd import DITHER_ALGORITHMS
+
+
+def noise_image(width, height):
+    """Creates an image of random colors, which diffuses error everywhere."""
+
+    pixels = random.default_rng(0).integers(0, 256, (height, width, 3))
+    return Image.fromarray(pixels.astype(uint8))
+
+
+class AtkinsonTest(TestCase):
+    """Tests for Atkinson dithering, which diffuses error two pixels away."""
+
+    def test_narrow_and_short_images(self):
+        for width, height in [(1, 17), (2, 17), (17, 1), (17, 2), (1, 1),
+                              (2, 2)]:
+            image = noise_image(width, height)
+            epd_image = to_epd_image(image, 'bwr', dither='atkinson')
+            self.assertEqual(epd_image.size, (width, height))
+            self.assertEqual(to_epd_image(image, 'bwr', dither='atkinson')
+                             .tobytes(), epd_image.tobytes())
+            self.assertTrue(to_epd_bytes(image, 'bwr', dither='atkinson'))
+
+
+class OrderedDitherTest(TestCase):
+    """Tests for Bayer and blue noise ordered dithering."""
+
+    def test_gray_tones(self):
+        white_index = 1
+        for dither in ['bayer', 'blue-noise']:
+            for gray in [30, 60, 128, 200, 230]:
+                image = Image.new('RGB', (64, 64), (gray, gray, gray))
+                indices = asarray(to_epd_image(image, 'bwr', dither=dither))
+                white_share = (indices == white_index).mean()
+                self.assertAlmostEqual(white_share, gray / 255, delta=0.02)
+
+
+class OutputsTest(TestCase):
+    """Tests that converting an image to several outputs at once matches
+    converting it to each on its own."""
+
+    def test_matches_single_outputs(self):
+        image = noise_image(37, 23)
+        outputs = [('bwr', 'raw'), ('7color', 'rle'), ('bwr', 'rle'),
+                   ('bwr', 'gif'), ('7color', 'gif')]
+        for dither in DITHER_ALGORITHMS:
+            indices = {}
+            results = to_epd_outputs(image, outputs, dither, indices)
+            for variant, output_format in outputs:
+                data = results[(variant, output_format)]
+                if output_format == 'gif':
+                    self.assertEqual(
+                        Image.open(BytesIO(data)).tobytes(),
+                        to_epd_image(image, variant, dither).tobytes())
+                else:
+                    self.assertEqual(data, to_epd_bytes(image, variant,
+                                                        dither, output_format))
+                self.assertEqual(
+                    indices[variant].tobytes(),
+                    to_epd_indices(image, variant, dither).tobytes())
+
+
+class WavefrontTest(TestCase):
+    """Tests that Floyd-Steinberg dithering with several threads gives the
+    same indices as with one."""
+
+    def test_matches_serial(self):
+        for variant in ['bwr', '7color']:
+            for width, height in [(37, 23), (101, 3), (5, 1)]:
+                pixels = asarray(noise_image(width, height))
+                indices = [dither_indices(pixels, epd_palette(variant),
+                                          threads=threads,
+                                          algorithm='floyd-steinberg',
+                                          lut=_palette_lut(variant))
+                           for threads in [1, 2, 3, 4, height + 5]]
+                for threaded_indices in indices[1:]:
+                    self.assertEqual(threaded_indices.tobytes(),
+                                     indices[0].tobytes())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+from PIL import Image
+from PIL.ImageDraw import Draw
+from unittest import main
+from unittest import TestCase
+
+from graphics import _character_widths
+from graphics import _font
+from graphics import draw_text
+from graphics import SCREENSTAR_SMALL_REGULAR
+from graphics import SUBVARIO_CONDENSED_MEDIUM
+
+
+def draw_characters(text, font_spec, xy, image, draw):
+    """Draws the text one character at a time with PIL, like draw_text()
+    places its glyphs."""
+
+    character_widths = _character_widths(text, font_spec, draw.fontmode)
+    x = xy[0] - sum(character_widths) // 2
+    y = xy[1] - font_spec['height'] // 2 - font_spec['y_offset']
+    for character, character_width in zip(text, character_widths):
+        draw.text((x, y), character, 'black', _font(font_spec))
+        x += character_width
+
+
+class DrawTextTest(TestCase):
+    """Tests that drawing text from glyph masks matches drawing it with PIL."""
+
+    def assert_matches_pil(self, mode, xy):
+        for font_spec in [SUBVARIO_CONDENSED_MEDIUM, SCREENSTAR_SMALL_REGULAR]:
+            images = []
+            for draw_function in [draw_characters, None]:
+                image = Image.new(mode, (200, 60), 'white')
+                draw = Draw(image)
+                if draw_function:
+                    draw_function('Mon ~12 vs', font_spec, xy, image, draw)
+                else:
+                    draw_text('Mon ~12 vs', font_spec, 'black', xy=xy,
+                              image=image, draw=draw)
+                images.append(image.tobytes())
+            self.assertEqual(images[0], images[1])
+
+    def test_integer_position(self):
+        for mode in ['RGB', 'L', '1']:
+            self.assert_matches_pil(mode, (100, 30))
+
+    def test_fractional_position(self):
+        for mode in ['RGB', 'L', '1']:
+            self.assert_matches_pil(mode, (100.37, 30.5))
+            self.assert_matches_pil(mode, (57.8, 29.25))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+from unittest import main
+from unittest import TestCase
+
+from graphics import SUBVARIO_CONDENSED_MEDIUM
+from layout import ELLIPSIS
+from layout import wrap
+
+# Text long enough to need several lines.
+TEXT = 'The quick brown fox jumps over the lazy dog ' * 4
+
+
+class WrapTest(TestCase):
+    """Tests for wrapping text to a width."""
+
+    def test_max_lines_by_keyword(self):
+        lines = wrap(TEXT, SUBVARIO_CONDENSED_MEDIUM, 200, max_lines=2)
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[-1].endswith(ELLIPSIS))
+
+    def test_max_lines_by_position_and_keyword_match(self):
+        self.assertEqual(wrap(TEXT, SUBVARIO_CONDENSED_MEDIUM, 200, 3),
+                         wrap(TEXT, SUBVARIO_CONDENSED_MEDIUM, 200,
+                              max_lines=3))
+
+    def test_without_max_lines(self):
+        lines = wrap(TEXT, SUBVARIO_CONDENSED_MEDIUM, 200)
+        self.assertGreater(len(lines), 3)
+        self.assertFalse(lines[-1].endswith(ELLIPSIS))
+
+
+if __name__ == '__main__':
+    main()